@@ -1,21 +1,25 @@
 import os
-import json
-from collections import namedtuple
-import tempfile
 from functools import wraps
 from datetime import datetime, timedelta
 import random
+import threading
 
 import flask
+import sqlalchemy
 from flask import render_template
 import flask_login
 from flask_login import login_required
-import pandas as pd
 from . import recorder
-
-Slider = namedtuple(
-    'Slider',
-    ['label_id', 'label', 'label_left', 'label_right', 'allow_center'])
+from . import experiment
+from .experiment import Slider
+from .fragments import CaseFragments
+from .codec import CompactCodec
+from . import httpcache
+from .state import make_state_store
+from .cache import LRUCache
+from .writebehind import WriteBehindBuffer
+from .events import ProgressEvents
+from .order import CaseOrder, CaseOrders
 
 
 class User(flask_login.UserMixin):
@@ -55,6 +59,24 @@ def nonadmin_required(f):
     return wrap
 
 
+def api_login_required(f):
+    '''
+    login_required for the JSON API. Returns 401 instead of redirecting
+    to the login page.
+    '''
+    @wraps(f)
+    def wrap(*args, **kwargs):
+        if flask_login.current_user.is_authenticated:
+            return f(*args, **kwargs)
+        else:
+            return {'result': 'failure', 'reason': 'login required'}, 401
+
+    return wrap
+
+
+API_VERSION = 1
+
+
 def create_app(test_config=None):
     app = flask.Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
@@ -65,7 +87,27 @@ def create_app(test_config=None):
         DIAGNOSIS_CSV=os.environ.get('DIAGNOSIS_CSV', 'diagnosis.csv'),
         REF_DATA_CSV=os.environ.get('REF_DATA_CSV', 'reference.csv'),
         INTERVAL=os.environ.get('INTERVAL', '1'),
-        RECORD_DB=os.environ.get('RECORD_DB', 'sqlite:///records.sqlite3'))
+        RECORD_DB=os.environ.get('RECORD_DB', 'sqlite:///records.sqlite3'),
+        STORAGE_PROFILE=os.environ.get('STORAGE_PROFILE', 'default'),
+        PROGRESS_COUNTERS=os.environ.get('PROGRESS_COUNTERS', '0'),
+        NORMALIZE_VALUES=os.environ.get('NORMALIZE_VALUES', '0'),
+        JOURNAL=os.environ.get('JOURNAL', '0'),
+        RECORD_CODEC=os.environ.get('RECORD_CODEC', 'json'),
+        EXPORT_OVERLAP=os.environ.get(
+            'EXPORT_OVERLAP', str(recorder.EXPORT_OVERLAP.total_seconds())),
+        AUTO_MIGRATE=os.environ.get('AUTO_MIGRATE', '1'),
+        DASHBOARD_CACHE_SIZE=os.environ.get('DASHBOARD_CACHE_SIZE', '256'),
+        DASHBOARD_CACHE_TTL=os.environ.get('DASHBOARD_CACHE_TTL', '60'),
+        DASHBOARD_PAGE_SIZE=os.environ.get('DASHBOARD_PAGE_SIZE', '100'),
+        WRITE_BEHIND_INTERVAL=os.environ.get('WRITE_BEHIND_INTERVAL', '0'),
+        WRITE_BEHIND_SIZE=os.environ.get('WRITE_BEHIND_SIZE', '100'),
+        EXPERIMENT_SNAPSHOT=os.environ.get('EXPERIMENT_SNAPSHOT', '1'),
+        RELOAD_INTERVAL=os.environ.get('RELOAD_INTERVAL', '0'),
+        COMPRESS_MIN_SIZE=os.environ.get('COMPRESS_MIN_SIZE', '500'),
+        METRICS=os.environ.get('METRICS', '0'),
+        STATE_BACKEND=os.environ.get('STATE_BACKEND', 'memory'),
+        EVENTS_KEEPALIVE=os.environ.get('EVENTS_KEEPALIVE', '15'),
+        STATIC_MAX_AGE=os.environ.get('STATIC_MAX_AGE', str(365 * 24 * 3600)))
 
     if test_config is None:
         app.config.from_pyfile('config.py', silent=True)
@@ -74,6 +116,29 @@ def create_app(test_config=None):
 
     os.makedirs(app.instance_path, exist_ok=True)
 
+    # static files are versioned by mtime in the urls, so cache them long
+    app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(app.config['STATIC_MAX_AGE'])
+    compress_min_size = int(app.config['COMPRESS_MIN_SIZE'])
+
+    @app.after_request
+    def compress_response(response):
+        return httpcache.compress(response, flask.request, compress_min_size)
+
+    @app.context_processor
+    def static_version():
+        def static_url(filename):
+            path = os.path.join(app.static_folder, filename)
+            return '/static/{}?v={}'.format(filename,
+                                            int(os.path.getmtime(path)))
+
+        return dict(static_url=static_url)
+
+    def assets_version():
+        # pages link the static files by mtime, so they change with them too
+        return httpcache.assets_version(
+            os.path.join(app.root_path, app.template_folder),
+            app.static_folder)
+
     MIN_DELTA = timedelta(minutes=float(app.config['INTERVAL']))
     print('interval', MIN_DELTA)
 
@@ -86,46 +151,138 @@ def create_app(test_config=None):
     login_manager.init_app(app)
     login_manager.login_view = 'login'
 
-    rng_seeds = {}
+    exp = experiment.load_experiment(
+        app.config, app.instance_path
+        if app.config['EXPERIMENT_SNAPSHOT'] == '1' else None)
+    print(len(exp.users), 'users found.')
+    print(len(exp.item_ids), 'items found.')
+    print(len(exp.diagnosis_items), 'diagnosis items found.')
+
+    db = recorder.RecordDB(
+        app.config['RECORD_DB'],
+        False,
+        progress_counters=app.config['PROGRESS_COUNTERS'] == '1',
+        profile=app.config['STORAGE_PROFILE'],
+        normalize_values=app.config['NORMALIZE_VALUES'] == '1',
+        journal=app.config['JOURNAL'] == '1',
+        codec=CompactCodec(exp.item_ids)
+        if app.config['RECORD_CODEC'] == 'compact' else None,
+        migrate=app.config['AUTO_MIGRATE'] == '1')
+    db.check_schema()
+
+    metrics = None
+    if app.config['METRICS'] == '1':
+        from .metrics import Metrics
+        metrics = Metrics()
+        metrics.init_app(app, db.engine)
+
+    login_states = make_state_store(app.config['STATE_BACKEND'], db)
+
+    drafts = WriteBehindBuffer(db, float(app.config['WRITE_BEHIND_INTERVAL']),
+                               int(app.config['WRITE_BEHIND_SIZE']))
+    if (drafts.enabled
+            and threading.current_thread() is threading.main_thread()):
+        # atexit does not run when the service is stopped by SIGTERM
+        drafts.drain_on_signals()
+
+    # the cache is patched by the writes of this process only, so it would
+    # serve stale states when several processes share the record DB
+    dashboard_cache = LRUCache(
+        0 if app.config['STATE_BACKEND'] == 'db' else int(
+            app.config['DASHBOARD_CACHE_SIZE']),
+        float(app.config['DASHBOARD_CACHE_TTL']))
+
+    def patch_dashboard(states):
+        for state in states:
+
+            def patch(cached):
+                rec_dict, ai_rec_dict = cached
+                if state.ai:
+                    ai_rec_dict = patched(ai_rec_dict)
+                else:
+                    rec_dict = patched(rec_dict)
+                return rec_dict, ai_rec_dict
 
-    df_users = pd.read_csv(app.config['USERS_CSV'])
-    users = {
-        username: {
-            'password': pw
-        }
-        for username, pw in zip(df_users['username'], df_users['password'])
-    }
-    print(len(users), 'users found.')
-    with open(app.config['CASE_IDS_TXT']) as f:
-        case_ids = f.read().splitlines()
-    case_ids_set = set(case_ids)
-
-    df_items = pd.read_csv(app.config['ITEMS_CSV'], encoding='cp932')
-    print(len(df_items), 'items found.')
-    df_diagnosis = pd.read_csv(app.config['DIAGNOSIS_CSV'], encoding='cp932')
-    print(len(df_diagnosis), 'diagnosis items found.')
-    slider_groups = {}
-    for group, df_group in df_items.groupby('group', sort=False):
-        slider_groups[group] = df_group.apply(
-            lambda row: Slider(row.get('id'), row.get('name'), row.left, row.
-                               right, row.allow_center),
-            axis=1)
-
-    df_ref = pd.read_csv(app.config['REF_DATA_CSV'],
-                         index_col='id',
-                         encoding='cp932')
-    assert set(df_ref.index) == case_ids_set, 'Invalid input'
-    assert set(df_ref.columns) == set(df_items['id'].values), 'Invalid input'
-
-    ref_dict = {}
-    for case_id in df_ref.index:
-        ref_dict[case_id] = df_ref.loc[case_id].to_dict()
-
-    db = recorder.RecordDB(app.config['RECORD_DB'], False)
+            def patched(records):
+                records = dict(records)
+                if state.completed is None:  # removed by a bulk operation
+                    records.pop(state.case_id, None)
+                else:
+                    records[state.case_id] = state
+                return records
+
+            dashboard_cache.update(state.username, patch)
+
+    db.add_listener(patch_dashboard)
+
+    case_orders = CaseOrders(int(app.config['DASHBOARD_CACHE_SIZE']))
+    page_size = int(app.config['DASHBOARD_PAGE_SIZE'])
+
+    def get_case_order(username):
+        exp, version = loaded_experiment()
+        return case_orders.get(username, exp.case_ids,
+                               login_states.get_seed(username), version)
+
+    progress_events = ProgressEvents(db, float(app.config['EVENTS_KEEPALIVE']))
+
+    agreement = None
+
+    def get_agreement():
+        nonlocal agreement
+        if agreement is None:  # numpy is imported on first use
+            from .analytics import Agreement
+            exp = loaded_experiment().experiment
+            agreement = Agreement([u for u in exp.users if u != 'admin'],
+                                  exp.case_ids, exp.item_ids, exp.ref_dict)
+            db.add_listener(agreement.invalidate)
+        return agreement
+
+    def reset_agreement(exp):
+        nonlocal agreement
+        if agreement is not None:
+            db.remove_listener(agreement.invalidate)
+            agreement = None
+
+    case_fragments = (None, None)
+
+    def get_case_fragments(exp):
+        nonlocal case_fragments
+        compiled_for, fragments = case_fragments
+        if compiled_for is not exp:
+            fragments = CaseFragments(exp.slider_groups, exp.diagnosis_items)
+            case_fragments = (exp, fragments)
+        return fragments
+
+    reloader = experiment.ExperimentReloader(
+        app.config,
+        exp,
+        float(app.config['RELOAD_INTERVAL']),
+        on_reload=reset_agreement)
+
+    def loaded_experiment():
+        '''
+        The experiment and its version, read once per request so that the
+        lookups, the cached case orders and the ETags of a request agree
+        even if the experiment is reloaded meanwhile.
+        '''
+        if 'loaded_experiment' not in flask.g:
+            flask.g.loaded_experiment = reloader.loaded
+        return flask.g.loaded_experiment
+
+    def get_dashboard_state(username):
+        drafts.flush(username=username)
+        cached = dashboard_cache.get(username)
+        if cached is None:
+            # not cached if a write is notified while reading
+            generation = dashboard_cache.generation(username)
+            with db.new_session() as sess:
+                cached = db.dashboard_state(username, sess)
+            dashboard_cache.set(username, cached, generation)
+        return cached
 
     @login_manager.user_loader
     def user_loader(username):
-        if username not in users:
+        if username not in loaded_experiment().experiment.users:
             return
 
         user = User(username)
@@ -134,6 +291,7 @@ def create_app(test_config=None):
     @login_manager.request_loader
     def request_loader(request):
         username = request.form.get('username')
+        users = loaded_experiment().experiment.users
         if username not in users:
             return
 
@@ -143,9 +301,6 @@ def create_app(test_config=None):
 
         return user
 
-    def obj2bytes(obj):
-        return json.dumps(obj).encode('utf8')
-
     @app.errorhandler(403)
     def page_forbidden(e):
         return render_template('error.html', title='403 Forbidden.',
@@ -161,78 +316,310 @@ def create_app(test_config=None):
     @login_required
     @admin_required
     def admin():
+        exp = loaded_experiment().experiment
         users_progress = {}
         with db.new_session() as sess:
-            for username in df_users['username']:
-                if username == 'admin':
-                    continue
-                matches = sess.query(db.Record).filter_by(username=username,
-                                                          completed=True)
-                progress = matches.count()
-                users_progress[username] = dict(progress=progress,
-                                                completed=progress == 2 *
-                                                len(case_ids))
+            summary = db.progress_summary(sess)
+        for username in exp.users:
+            if username == 'admin':
+                continue
+            counts = summary.get(username, {})
+            progress = counts.get((False, True), 0) + counts.get(
+                (True, True), 0)
+            users_progress[username] = dict(progress=progress,
+                                            completed=progress == 2 *
+                                            len(exp.case_ids))
         return render_template('admin.html',
                                title='Admin page',
-                               users_progress=users_progress)
+                               users_progress=users_progress,
+                               n_total=2 * len(exp.case_ids))
+
+    @app.route('/admin/events')
+    @login_required
+    @admin_required
+    def admin_events():
+        return flask.Response(progress_events.stream(),
+                              mimetype='text/event-stream',
+                              headers={
+                                  'Cache-Control': 'no-cache',
+                                  'X-Accel-Buffering': 'no'
+                              })
+
+    @app.route('/admin/analytics')
+    @login_required
+    @admin_required
+    def analytics():
+        drafts.flush()
+        with db.new_session() as sess:
+            return get_agreement().summary(db, sess)
+
+    @app.route('/admin/metrics')
+    @login_required
+    @admin_required
+    def admin_metrics():
+        if metrics is None:
+            flask.abort(404, 'Metrics are disabled.')
+        return flask.Response(metrics.render(),
+                              mimetype='text/plain; version=0.0.4')
+
+    export_overlap = timedelta(seconds=float(app.config['EXPORT_OVERLAP']))
+
+    def export_response(iter_export, filename, mimetype):
+        since = flask.request.args.get('since')
+        if since:
+            try:
+                since = datetime.fromisoformat(since)
+            except ValueError:
+                flask.abort(400, 'Invalid since: {}'.format(since))
+        else:
+            since = None
+        drafts.flush()
+        with db.new_session() as sess:
+            watermark = db.export_watermark(since, sess)
+        if since is not None:
+            since -= export_overlap
+
+        def generate():
+            with db.new_session() as sess:
+                yield from iter_export(sess, since=since, until=watermark)
+
+        headers = {
+            'Content-Disposition': 'attachment; filename={}'.format(filename)
+        }
+        if watermark is not None:
+            headers['X-Watermark'] = watermark.isoformat()
+        return flask.Response(generate(), mimetype=mimetype, headers=headers)
 
     @app.route('/admin/download/csv')
     @login_required
     @admin_required
     def csv():
-        with tempfile.NamedTemporaryFile(suffix='.csv') as temp:
-            temp.close()
-            with db.new_session() as sess:
-                db.to_csv(temp.name, sess)
-            return flask.send_file(temp.name,
-                                   as_attachment=True,
-                                   attachment_filename='database.csv',
-                                   mimetype='text/csv')
+        return export_response(db.iter_csv, 'database.csv', 'text/csv')
+
+    @app.route('/admin/download/jsonl')
+    @login_required
+    @admin_required
+    def jsonl():
+        return export_response(db.iter_jsonl, 'database.jsonl',
+                               'application/x-ndjson')
 
     @app.route('/user/<username>/')
     @login_required
     @admin_required
     def admin_user(username):
-        if username not in users:
+        if username not in loaded_experiment().experiment.users:
             flask.flash('User: {} not found.'.format(username), 'failed')
             return flask.redirect('/')
-        return user_dashboard(username,
-                              '{}のダッシュボード'.format(username),
-                              admin=True)
+        return user_dashboard(username, '{}のダッシュボード'.format(username))
 
-    def user_dashboard(username, title='ダッシュボード', admin=False):
-        with db.new_session() as sess:
-            recs = sess.query(db.Record).filter_by(username=username, ai=False)
-            rec_dict = {r.case_id: r for r in recs}
+    def user_dashboard(username, title):
+        '''
+        The user's dashboard for the admin, rendered on the server in the
+        original case order.
+        '''
+        exp, version = loaded_experiment()
+        case_ids = exp.case_ids
+        rec_dict, ai_rec_dict = get_dashboard_state(username)
+        order = CaseOrder(case_ids)
+        n_pages = order.n_pages(page_size)
+        page = flask.request.args.get('page', 1, type=int)
+        page = min(max(page, 1), n_pages)
+        now = datetime.now()
+
+        def render():
             n_done = sum([1 for r in rec_dict.values() if r.completed])
-            ai_recs = sess.query(db.Record).filter_by(username=username,
-                                                      ai=True)
-            ai_rec_dict = {r.case_id: r for r in ai_recs}
             ai_n_done = sum([1 for r in ai_rec_dict.values() if r.completed])
-        if admin:
-            shuffled_case_ids = case_ids
+            progress = '{}/{}, {}/{}'.format(n_done, len(case_ids), ai_n_done,
+                                             len(case_ids))
+            return render_template('index.html',
+                                   title=title,
+                                   username=username,
+                                   case_ids=order.page(page, page_size),
+                                   page=page,
+                                   n_pages=n_pages,
+                                   progress=progress,
+                                   records=rec_dict,
+                                   ai_records=ai_rec_dict,
+                                   now=now,
+                                   admin=True,
+                                   min_delta=MIN_DELTA)
+
+        # the page changes when a fixed case passes the interval
+        waiting = [
+            r.case_id for r in rec_dict.values()
+            if r.completed and now - r.last_update <= MIN_DELTA
+        ]
+        etag = httpcache.make_etag(version, username, title, len(case_ids),
+                                   page, page_size, sorted(rec_dict.items()),
+                                   sorted(ai_rec_dict.items()), waiting,
+                                   assets_version())
+        return httpcache.conditional(etag, render)
+
+    def reader_dashboard(username):
+        '''
+        A static page that renders the dashboard from api_cases, so that it
+        only changes with the user and the deployed templates.
+        '''
+        def render():
+            return render_template(
+                'dashboard.html',
+                title='ダッシュボード',
+                username=username,
+                api_url='/api/v{}/cases'.format(API_VERSION))
+
+        etag = httpcache.make_etag(API_VERSION, username, assets_version())
+        return httpcache.conditional(etag, render)
+
+    @app.route('/next')
+    @login_required
+    @nonadmin_required
+    def next_case():
+        '''
+        Redirect to the first case in the user's order that can be read,
+        preferring the with-AI reading of a case fixed without AI.
+        '''
+        username = flask_login.current_user.id
+        rec_dict, ai_rec_dict = get_dashboard_state(username)
+        order = get_case_order(username)
+
+        def done(records):
+            return {
+                case_id
+                for case_id, record in records.items() if record.completed
+            }
+
+        now = datetime.now()
+
+        def readable(case_id):
+            wo_rec = rec_dict.get(case_id)
+            return bool(wo_rec and wo_rec.completed
+                        and now - wo_rec.last_update > MIN_DELTA)
+
+        ai_done = done(ai_rec_dict)
+        ai_case_id = order.next_unread(True, ai_done)
+        if ai_case_id is not None:
+            # the first case may still wait for the interval while a later
+            # one, fixed before it, is readable already
+            ready = ai_case_id if readable(ai_case_id) else order.first(
+                case_id for case_id in rec_dict
+                if case_id not in ai_done and readable(case_id))
+            if ready is not None:
+                return flask.redirect('/w/case/{}'.format(ready))
+        case_id = order.next_unread(False, done(rec_dict))
+        if case_id is not None:
+            return flask.redirect('/wo/case/{}'.format(case_id))
+        if ai_case_id is not None:
+            flask.flash('{}はまだ読影できません。'.format(ai_case_id), 'failed')
         else:
-            seed = rng_seeds.get(username, 0)
-            random.seed(seed)
-            shuffled_case_ids = random.sample(case_ids, len(case_ids))
-        progress = '{}/{}, {}/{}'.format(n_done, len(case_ids), ai_n_done,
-                                         len(case_ids))
-        return render_template('index.html',
-                               title=title,
-                               username=username,
-                               case_ids=shuffled_case_ids,
-                               progress=progress,
-                               records=rec_dict,
-                               ai_records=ai_rec_dict,
-                               now=datetime.now(),
-                               admin=admin,
-                               min_delta=MIN_DELTA)
+            flask.flash('未読の症例はありません。', 'success')
+        return flask.redirect('/')
+
+    def record_json(rec):
+        if rec is None:
+            return dict(status='none', last_update=None, elapsed_time=0)
+        return dict(status='completed' if rec.completed else 'draft',
+                    last_update=rec.last_update.isoformat(),
+                    elapsed_time=rec.elapsed_time)
+
+    @app.route('/api/v{}/cases'.format(API_VERSION))
+    @app.route('/api/cases')
+    @api_login_required
+    @nonadmin_required
+    def api_cases():
+        '''
+        Record state of the user's cases on a dashboard page, in the
+        user's order.
+        '''
+        username = flask_login.current_user.id
+        exp, version = loaded_experiment()
+        case_ids = exp.case_ids
+        rec_dict, ai_rec_dict = get_dashboard_state(username)
+        order = get_case_order(username)
+        n_pages = order.n_pages(page_size)
+        page = flask.request.args.get('page', 1, type=int)
+        page = min(max(page, 1), n_pages)
+        now = datetime.now()
+
+        def render():
+            cases = []
+            for case_id in order.page(page, page_size):
+                rec = rec_dict.get(case_id)
+                ai_rec = ai_rec_dict.get(case_id)
+                if rec is None or (ai_rec is not None
+                                   and ai_rec.elapsed_time == 0):
+                    ai_rec = None  # the draft seeded by the fix is unread
+                w = record_json(ai_rec)
+                w['readable'] = bool(rec and rec.completed and
+                                     (ai_rec is None or not ai_rec.completed)
+                                     and now - rec.last_update > MIN_DELTA)
+                cases.append(dict(case_id=case_id, wo=record_json(rec), w=w))
+            progress = {
+                w_wo:
+                dict(completed=sum(1 for r in records.values() if r.completed),
+                     total=len(case_ids))
+                for w_wo, records in [('wo', rec_dict), ('w', ai_rec_dict)]
+            }
+            return dict(version=API_VERSION,
+                        username=username,
+                        progress=progress,
+                        page=page,
+                        n_pages=n_pages,
+                        cases=cases)
+
+        waiting = [
+            r.case_id for r in rec_dict.values()
+            if r.completed and now - r.last_update <= MIN_DELTA
+        ]
+        etag = httpcache.make_etag(API_VERSION, version, username, order.seed,
+                                   page, page_size, sorted(rec_dict.items()),
+                                   sorted(ai_rec_dict.items()), waiting)
+        return httpcache.conditional(etag, render)
+
+    @app.route('/api/v{}/case/<w_wo>/<case_id>'.format(API_VERSION))
+    @app.route('/api/case/<w_wo>/<case_id>')
+    @api_login_required
+    @nonadmin_required
+    def api_case(w_wo, case_id):
+        '''
+        The user's record of the case and the reference values shown
+        with AI.
+        '''
+        exp, version = loaded_experiment()
+        username = flask_login.current_user.id
+        ai = w_wo == 'w'
+        if case_id not in exp.case_ids_set:
+            return {'result': 'failure', 'reason': 'case_id not found'}, 404
+        drafts.flush(keys=[(username, case_id, False), (username, case_id,
+                                                        True)])
+        with db.new_session() as sess:
+            if ai:
+                wo_rec = db.get_record(username, case_id, False, sess)
+                if (not wo_rec or not wo_rec.completed
+                        or datetime.now() - wo_rec.last_update < MIN_DELTA):
+                    return {
+                        'result': 'failure',
+                        'reason': 'case is not readable yet'
+                    }, 403
+            rec = db.get_record(username, case_id, ai, sess)
+
+        def render():
+            return dict(version=API_VERSION,
+                        case_id=case_id,
+                        ai=ai,
+                        completed=bool(rec and rec.completed),
+                        elapsed_time=rec.elapsed_time if rec else 0,
+                        data=db.decode_data(rec.data) if rec else {},
+                        ref_data=exp.ref_dict[case_id] if ai else {})
+
+        etag = httpcache.make_etag(API_VERSION, version, username, case_id, ai,
+                                   rec.last_update if rec else None)
+        return httpcache.conditional(etag, render)
 
     @app.route('/user/<username>/<w_wo>/case/<case_id>')
     @login_required
     @admin_required
     def admin_user_case(username, case_id, w_wo):
-        if username not in users:
+        if username not in loaded_experiment().experiment.users:
             flask.flash('User: {} not found.'.format(username), 'failed')
             return flask.redirect('/')
         return render_case(username, case_id, w_wo == 'w', True)
@@ -243,7 +630,7 @@ def create_app(test_config=None):
             if flask_login.current_user.id == 'admin':
                 return flask.redirect('/admin')
             else:
-                return user_dashboard(flask_login.current_user.id)
+                return reader_dashboard(flask_login.current_user.id)
         else:
             return flask.redirect('/login')
 
@@ -257,6 +644,7 @@ def create_app(test_config=None):
 
         if flask.request.method == 'POST':
             username = flask.request.form['username']
+            users = loaded_experiment().experiment.users
             if username not in users:
                 flask.flash('User "{}" not found.'.format(username), 'failed')
                 return flask.redirect('/login')
@@ -264,7 +652,7 @@ def create_app(test_config=None):
             if flask.request.form['password'] == users[username]['password']:
                 user = User(username)
                 flask_login.login_user(user)
-                rng_seeds[username] = random.randint(0, 10000)
+                login_states.set_seed(username, random.randint(0, 10000))
                 next_url = flask.request.args.get('next')
                 if next_url:
                     return flask.redirect(next_url)
@@ -289,7 +677,10 @@ def create_app(test_config=None):
         '''
         read_only for admin view
         '''
-        if case_id in case_ids_set:
+        exp, version = loaded_experiment()
+        if case_id in exp.case_ids_set:
+            keys = [(username, case_id, False), (username, case_id, True)]
+            drafts.flush(keys=keys)
             if ai:  # to edit w/ ai, w/o ai needs to be completed and MIN_DELTA
                 with db.new_session() as sess:
                     wo_rec = db.get_record(username, case_id, False, sess)
@@ -301,32 +692,39 @@ def create_app(test_config=None):
 
             with db.new_session() as sess:
                 rec = db.get_record(username, case_id, ai, sess)
-            if rec:
-                data = json.loads(rec.data.decode('utf8'))
-                completed = rec.completed
-                if completed:
-                    flask.flash('{}はすでに確定しています。'.format(case_id), 'failed')
-                    return flask.redirect('/')
-                elapsed_time = rec.elapsed_time
-            else:
-                data = {}
-                completed = False
-                elapsed_time = 0
-            if ai:
-                ref_data = ref_dict[case_id]
-            else:
-                ref_data = {}
-            return render_template('case.html',
-                                   title=case_id,
-                                   username=username,
-                                   case_id=case_id,
-                                   completed=completed,
-                                   elapsed_time=elapsed_time,
-                                   slider_groups=slider_groups,
-                                   diagnosis_items=df_diagnosis,
-                                   ref_data=ref_data,
-                                   data=data,
-                                   read_only=read_only)
+            if rec and rec.completed:
+                flask.flash('{}はすでに確定しています。'.format(case_id), 'failed')
+                return flask.redirect('/')
+
+            def render():
+                if rec:
+                    data = db.decode_data(rec.data)
+                    completed = rec.completed
+                    elapsed_time = rec.elapsed_time
+                else:
+                    data = {}
+                    completed = False
+                    elapsed_time = 0
+                if ai:
+                    ref_data = exp.ref_dict[case_id]
+                else:
+                    ref_data = {}
+                return render_template('case.html',
+                                       title=case_id,
+                                       username=username,
+                                       case_id=case_id,
+                                       completed=completed,
+                                       elapsed_time=elapsed_time,
+                                       fragments=get_case_fragments(exp),
+                                       ref_data=ref_data,
+                                       data=data,
+                                       read_only=read_only)
+
+            etag = httpcache.make_etag(version, username, case_id, ai,
+                                       read_only,
+                                       rec.last_update if rec else None,
+                                       assets_version())
+            return httpcache.conditional(etag, render)
         else:
             flask.flash('Case "{}" not found.'.format(case_id), 'failed')
             return flask.redirect('/')
@@ -340,14 +738,12 @@ def create_app(test_config=None):
         if flask.request.method == 'GET':
             return render_case(username, case_id, is_ai)
         else:
-            if case_id in case_ids:
-                with db.new_session() as sess:
-                    data = recorder.record_data2obj(flask.request.get_data())
-                    et = data.pop('elapsed_time', 0)
-                    data = obj2bytes(data)
-                    db.update_record(username, case_id, data, et, is_ai, False,
-                                     sess)
-                    return {'result': 'success'}, 200
+            if case_id in loaded_experiment().experiment.case_ids_set:
+                data = recorder.record_data2obj(flask.request.get_data())
+                et = data.pop('elapsed_time', 0)
+                data = db.encode_data(data)
+                drafts.put(username, case_id, data, et, is_ai)
+                return {'result': 'success'}, 200
             else:
                 return {
                     'result': 'failure',
@@ -360,16 +756,14 @@ def create_app(test_config=None):
     def fix_case(case_id, w_wo):
         is_ai = w_wo == 'w'
         username = flask_login.current_user.id
-        if case_id in case_ids:
+        if case_id in loaded_experiment().experiment.case_ids_set:
             with db.new_session() as sess:
                 data = recorder.record_data2obj(flask.request.get_data())
                 et = data.pop('elapsed_time', 0)
-                data = obj2bytes(data)
-                db.update_record(username, case_id, data, et, is_ai, True,
-                                 sess)
-                if not is_ai:  # copy to ai
-                    db.update_record(username, case_id, data, 0, True, False,
-                                     sess)
+                data = db.encode_data(data)
+                drafts.discard([(username, case_id, is_ai),
+                                (username, case_id, True)])
+                db.fix_record(username, case_id, data, et, is_ai, sess)
                 return {'result': 'success'}, 200
         else:
             return {'result': 'failure', 'reason': 'case_id not found'}, 404
@@ -379,13 +773,62 @@ def create_app(test_config=None):
     @admin_required
     def unfix_case(username, w_wo, case_id):
         is_ai = w_wo == 'w'
-        if case_id in case_ids:
+        if case_id in loaded_experiment().experiment.case_ids_set:
+            drafts.flush(keys=[(username, case_id, is_ai)])
             with db.new_session() as sess:
-                record = db.get_record(username, case_id, is_ai, sess)
-                db.update_record(username, case_id, record.data,
-                                 record.elapsed_time, is_ai, False, sess)
+                db.bulk_update('unfix', [username], [case_id],
+                               is_ai,
+                               sess=sess)
+                if db.get_record(username, case_id, is_ai, sess) is None:
+                    return {
+                        'result': 'failure',
+                        'reason': 'record not found'
+                    }, 404
             return {'result': 'success'}, 200
         else:
             return {'result': 'failure', 'reason': 'case_id not found'}, 404
 
+    @app.route('/admin/bulk', methods=['POST'])
+    @login_required
+    @admin_required
+    def admin_bulk():
+        '''
+        Apply unfix, reset or reassign to the selected records, e.g.
+        {"operation": "unfix", "users": ["alice"], "cases": null, "ai": true}
+        Omitted or null selectors select all. reassign needs "to".
+        '''
+        exp = loaded_experiment().experiment
+        params = flask.request.get_json(silent=True)
+        if not isinstance(params, dict):
+            return {'result': 'failure', 'reason': 'invalid json'}, 400
+        operation = params.get('operation')
+        usernames = params.get('users')
+        case_ids = params.get('cases')
+        ai = params.get('ai')
+        new_username = params.get('to')
+        if operation not in recorder.BULK_OPERATIONS:
+            return {'result': 'failure', 'reason': 'invalid operation'}, 400
+        for selector in [usernames, case_ids]:
+            if selector is not None and not (isinstance(selector, list)
+                                             and all(
+                                                 isinstance(value, str)
+                                                 for value in selector)):
+                return {'result': 'failure', 'reason': 'invalid selector'}, 400
+        if ai is not None and not isinstance(ai, bool):
+            return {'result': 'failure', 'reason': 'invalid selector'}, 400
+        if operation == 'reassign' and (new_username not in exp.users
+                                        or new_username == 'admin'):
+            return {'result': 'failure', 'reason': 'invalid user'}, 400
+        drafts.flush()
+        with db.new_session() as sess:
+            try:
+                count = db.bulk_update(operation, usernames, case_ids, ai,
+                                       new_username, sess)
+            except sqlalchemy.exc.IntegrityError:
+                return {
+                    'result': 'failure',
+                    'reason': 'records already exist for the user'
+                }, 409
+        return {'result': 'success', 'count': count}, 200
+
     return app
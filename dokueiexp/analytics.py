@@ -0,0 +1,136 @@
+import threading
+import warnings
+
+import numpy as np
+import sqlalchemy
+
+WO_AI, W_AI = 0, 1
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def nanmean(a, axis):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmean(a, axis=axis)
+
+
+def to_list(a):
+    '''
+    ndarray to list with NaN replaced by None for JSON.
+    '''
+    return [None if np.isnan(v) else float(v) for v in a]
+
+
+class Agreement():
+    '''
+    Agreement between readers and the reference (AI) values.
+
+    Completed records are kept in a (2, users, cases, items) array,
+    index 0 for without AI and 1 for with AI, with NaN for missing values.
+    Changed records are reloaded incrementally on refresh.
+    '''
+    def __init__(self, usernames, case_ids, item_ids, ref_dict):
+        self.usernames = list(usernames)
+        self.case_ids = list(case_ids)
+        self.item_ids = list(item_ids)
+        self.user_index = {u: i for i, u in enumerate(self.usernames)}
+        self.case_index = {c: i for i, c in enumerate(self.case_ids)}
+        self.item_index = {c: i for i, c in enumerate(self.item_ids)}
+        self.reference = np.array([[
+            to_float(ref_dict[case_id].get(item_id)) for item_id in item_ids
+        ] for case_id in self.case_ids],
+                                  dtype=float).reshape(len(self.case_ids),
+                                                       len(self.item_ids))
+        self.values = np.full(
+            (2, len(self.usernames), len(self.case_ids), len(self.item_ids)),
+            np.nan,
+            dtype=float)
+        self._loaded = False
+        self._dirty = set()
+        self._summary = None
+        self._lock = threading.Lock()
+
+    def invalidate(self, states):
+        '''
+        RecordDB listener. Marks the records to be reloaded.
+        '''
+        with self._lock:
+            for state in states:
+                if (state.username in self.user_index
+                        and state.case_id in self.case_index):
+                    self._dirty.add(
+                        (state.username, state.case_id, bool(state.ai)))
+
+    def _set(self, username, case_id, ai, data, completed, decode):
+        row = self.values[int(ai), self.user_index[username],
+                          self.case_index[case_id]]
+        row[:] = np.nan
+        if completed:
+            for item_id, value in decode(data).items():
+                if item_id in self.item_index:
+                    row[self.item_index[item_id]] = to_float(value)
+
+    def refresh(self, db, sess):
+        with self._lock:
+            Record = db.Record
+            query = sess.query(Record.username, Record.case_id, Record.ai,
+                               Record.data, Record.completed)
+            if self._loaded:
+                if not self._dirty:
+                    return
+                dirty = list(self._dirty)
+                for username, case_id, ai in dirty:  # deleted records stay NaN
+                    self.values[int(ai), self.user_index[username],
+                                self.case_index[case_id]] = np.nan
+                query = query.filter(
+                    sqlalchemy.tuple_(Record.username, Record.case_id,
+                                      Record.ai).in_(dirty))
+            else:
+                query = query.filter(Record.completed.is_(True))
+            for username, case_id, ai, data, completed in query:
+                if (username in self.user_index
+                        and case_id in self.case_index):
+                    self._set(username, case_id, ai, data, completed,
+                              db.decode_data)
+            self._loaded = True
+            self._dirty.clear()
+            self._summary = None
+
+    def summary(self, db, sess):
+        '''
+        Mean absolute deviation from the reference and mean shift from
+        without AI to with AI, per item, per user and per case.
+        '''
+        self.refresh(db, sess)
+        with self._lock:
+            if self._summary is None:
+                self._summary = self._compute()
+            return self._summary
+
+    def _compute(self):
+        deviation = np.abs(self.values - self.reference[None, None])
+        shift = self.values[W_AI] - self.values[WO_AI]
+        # positive when with AI is closer to the reference
+        gain = deviation[WO_AI] - deviation[W_AI]
+
+        def per(axes4, axes3):
+            return dict(
+                deviation_wo_ai=to_list(nanmean(deviation[WO_AI], axes3)),
+                deviation_w_ai=to_list(nanmean(deviation[W_AI], axes3)),
+                shift=to_list(nanmean(shift, axes3)),
+                abs_shift=to_list(nanmean(np.abs(shift), axes3)),
+                gain=to_list(nanmean(gain, axes3)),
+                n_values=np.sum(~np.isnan(self.values), axis=axes4).T.tolist())
+
+        return dict(items=self.item_ids,
+                    users=self.usernames,
+                    cases=self.case_ids,
+                    per_item=per((1, 2), (0, 1)),
+                    per_user=per((2, 3), (1, 2)),
+                    per_case=per((1, 3), (0, 2)))
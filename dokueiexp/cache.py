@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache():
+    '''
+    Thread-safe LRU cache with a time-to-live for each entry.
+    maxsize <= 0 disables caching.
+    Each update of a key, cached or not, bumps its generation, so that a
+    value loaded before the update is not cached by set(generation=...).
+    '''
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def generation(self, key):
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def set(self, key, value, generation=None):
+        '''
+        Cache value. If generation is given, the value is dropped when key
+        was updated since generation(key) returned it.
+        '''
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if (generation is not None
+                    and generation != self._generations.get(key, 0)):
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def update(self, key, func):
+        '''
+        Replace the cached value with func(value) if key is cached.
+        The expiry time is kept as is.
+        '''
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (func(entry[0]), entry[1])
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return None if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,74 @@
+import json
+import struct
+import zlib
+
+VERSION = 1
+# version, crc32 of the item ids, diagnosis index
+HEADER = struct.Struct('<BIh')
+NO_DIAGNOSIS = -0x8000
+NOT_SET = 0xff
+
+
+class CompactCodec():
+    '''
+    Encode record data as a versioned array of slider values in item order.
+        header: version (uint8), crc32 of the item ids (uint32) and
+                diagnosis index (int16, NO_DIAGNOSIS if missing)
+        body: one uint8 per item, NOT_SET if the slider is not set
+    Data that does not fit (unknown keys, values out of range) is kept as
+    JSON, and decode accepts both.
+    '''
+    def __init__(self, item_ids):
+        self.item_ids = list(item_ids)
+        self.item_index = {
+            item_id: idx
+            for idx, item_id in enumerate(self.item_ids)
+        }
+        self.checksum = zlib.crc32('\n'.join(self.item_ids).encode('utf8'))
+
+    def encode(self, obj):
+        values = bytearray([NOT_SET]) * len(self.item_ids)
+        diagnosis = NO_DIAGNOSIS
+        for key, value in obj.items():
+            if key == 'diagnosis':
+                if (type(value) is not int
+                        or not NO_DIAGNOSIS < value <= 0x7fff):
+                    return encode_json(obj)
+                diagnosis = value
+                continue
+            idx = self.item_index.get(key)
+            if (idx is None or not isinstance(value, str)
+                    or not value.isdigit() or str(int(value)) != value
+                    or int(value) >= NOT_SET):
+                return encode_json(obj)
+            values[idx] = int(value)
+        return HEADER.pack(VERSION, self.checksum, diagnosis) + bytes(values)
+
+    def decode(self, data):
+        if is_json(data):
+            return decode_json(data)
+        version, checksum, diagnosis = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise ValueError('Unknown record data version: {}'.format(version))
+        if checksum != self.checksum:
+            raise ValueError('Record data was encoded for other items')
+        obj = {
+            item_id: str(value)
+            for item_id, value in zip(self.item_ids, data[HEADER.size:])
+            if value != NOT_SET
+        }
+        if diagnosis != NO_DIAGNOSIS:
+            obj['diagnosis'] = diagnosis
+        return obj
+
+
+def is_json(data):
+    return data[:1] == b'{'
+
+
+def encode_json(obj):
+    return json.dumps(obj).encode('utf8')
+
+
+def decode_json(data):
+    return json.loads(data.decode('utf8'))
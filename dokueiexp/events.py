@@ -0,0 +1,78 @@
+import json
+import queue
+import threading
+
+
+class ProgressEvents():
+    '''
+    Fan out record commits to server-sent event subscribers.
+    Each event carries the user's completed count, queried for the users
+    of each commit while there are subscribers.
+    A subscriber that falls behind by max_queue events is told to reload.
+    '''
+    def __init__(self, db, keepalive=15.0, max_queue=1000):
+        self.db = db
+        self.keepalive = keepalive
+        self.max_queue = max_queue
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        db.add_listener(self.publish)
+
+    def subscribe(self):
+        q = queue.Queue(self.max_queue)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def _count_completed(self, usernames):
+        with self.db.new_session() as sess:
+            summary = self.db.progress_summary(sess, usernames)
+        return {
+            username: sum(count for (ai, completed), count in counts.items()
+                          if completed)
+            for username, counts in summary.items()
+        }
+
+    def publish(self, states):
+        with self._lock:
+            if not self._subscribers:
+                return
+        completed = self._count_completed({state.username for state in states})
+        events = [
+            dict(username=state.username,
+                 case_id=state.case_id,
+                 ai=bool(state.ai),
+                 completed=bool(state.completed),
+                 progress=completed.get(state.username, 0)) for state in states
+        ]
+        with self._lock:
+            for q in self._subscribers:
+                for event in events:
+                    try:
+                        q.put_nowait(event)
+                    except queue.Full:
+                        break
+
+    def stream(self):
+        '''
+        Generate the text/event-stream body for one subscriber.
+        '''
+        q = self.subscribe()
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                if q.full():
+                    yield 'event: reload\ndata: {}\n\n'
+                    return
+                try:
+                    event = q.get(timeout=self.keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield 'data: {}\n\n'.format(json.dumps(event))
+        finally:
+            self.unsubscribe(q)
@@ -0,0 +1,267 @@
+'''
+Experiment inputs (users, cases, items, diagnosis and reference values)
+parsed without pandas, with a compiled snapshot cache.
+'''
+import os
+import csv
+import pickle
+import hashlib
+import threading
+from collections import namedtuple
+
+SNAPSHOT_VERSION = 2
+
+SOURCES = [
+    'USERS_CSV', 'CASE_IDS_TXT', 'ITEMS_CSV', 'DIAGNOSIS_CSV', 'REF_DATA_CSV'
+]
+
+Slider = namedtuple(
+    'Slider',
+    ['label_id', 'label', 'label_left', 'label_right', 'allow_center'])
+
+Diagnosis = namedtuple('Diagnosis', ['item', 'description'])
+
+Experiment = namedtuple('Experiment', [
+    'users', 'case_ids', 'case_ids_set', 'item_ids', 'slider_groups',
+    'diagnosis_items', 'ref_dict'
+])
+
+# an experiment and the version of the sources it was loaded from
+LoadedExperiment = namedtuple('LoadedExperiment', ['experiment', 'version'])
+
+
+def parse_bool(value):
+    return value.strip().lower() in ('true', '1', 'yes')
+
+
+def read_csv(filename, encoding='utf8'):
+    with open(filename, newline='', encoding=encoding) as f:
+        return list(csv.DictReader(f))
+
+
+def load_users(filename):
+    return {
+        row['username']: {
+            'password': row['password']
+        }
+        for row in read_csv(filename)
+    }
+
+
+def load_case_ids(filename):
+    with open(filename) as f:
+        return f.read().splitlines()
+
+
+def load_items(filename):
+    '''
+    Returns item ids and sliders grouped by the group column.
+    '''
+    rows = read_csv(filename, 'cp932')
+    slider_groups = {}
+    for row in rows:
+        slider_groups.setdefault(row['group'], []).append(
+            Slider(row['id'], row['name'], row['left'], row['right'],
+                   parse_bool(row['allow_center'])))
+    return [row['id'] for row in rows], slider_groups
+
+
+def load_diagnosis(filename):
+    return [
+        Diagnosis(row['item'], row['description'])
+        for row in read_csv(filename, 'cp932')
+    ]
+
+
+def load_reference(filename):
+    ref_dict = {}
+    for row in read_csv(filename, 'cp932'):
+        case_id = row.pop('id')
+        ref_dict[case_id] = row
+    return ref_dict
+
+
+def validate(experiment):
+    assert set(experiment.ref_dict) == set(
+        experiment.case_ids), 'Invalid input'
+    for values in experiment.ref_dict.values():
+        assert set(values) == set(experiment.item_ids), 'Invalid input'
+
+
+# fields of Experiment loaded from each source
+LOADERS = {
+    'USERS_CSV':
+    lambda filename: dict(users=load_users(filename)),
+    'CASE_IDS_TXT':
+    lambda filename: dict(case_ids=load_case_ids(filename)),
+    'ITEMS_CSV':
+    lambda filename: dict(
+        zip(['item_ids', 'slider_groups'], load_items(filename))),
+    'DIAGNOSIS_CSV':
+    lambda filename: dict(diagnosis_items=load_diagnosis(filename)),
+    'REF_DATA_CSV':
+    lambda filename: dict(ref_dict=load_reference(filename)),
+}
+
+
+def build_experiment(fields):
+    experiment = Experiment(case_ids_set=set(fields['case_ids']),
+                            **{
+                                key: value
+                                for key, value in fields.items()
+                                if key != 'case_ids_set'
+                            })
+    validate(experiment)
+    return experiment
+
+
+def compile_experiment(config):
+    fields = {}
+    for key in SOURCES:
+        fields.update(LOADERS[key](config[key]))
+    return build_experiment(fields)
+
+
+def file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def source_stats(config):
+    stats = []
+    for key in SOURCES:
+        st = os.stat(config[key])
+        stats.append(
+            (os.path.abspath(config[key]), st.st_mtime_ns, st.st_size))
+    return stats
+
+
+def snapshot_filename(config, cache_dir):
+    paths = '\n'.join(os.path.abspath(config[key]) for key in SOURCES)
+    return os.path.join(
+        cache_dir, 'experiment-{}.pickle'.format(
+            hashlib.sha1(paths.encode('utf8')).hexdigest()[:12]))
+
+
+def load_experiment(config, cache_dir=None):
+    '''
+    Load the experiment from the snapshot in cache_dir if the sources are
+    unchanged (same mtime, or same content hash), otherwise compile it
+    and write a new snapshot.
+    '''
+    if cache_dir is None:
+        return compile_experiment(config)
+
+    filename = snapshot_filename(config, cache_dir)
+    stats = source_stats(config)
+    snapshot = None
+    try:
+        with open(filename, 'rb') as f:
+            snapshot = pickle.load(f)
+        if snapshot['version'] != SNAPSHOT_VERSION:
+            snapshot = None
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError,
+            AttributeError, TypeError):  # missing or outdated snapshot
+        snapshot = None
+
+    if snapshot is not None:
+        if snapshot['stats'] == stats:
+            return snapshot['experiment']
+        hashes = [file_hash(path) for path, _, _ in stats]
+        if snapshot['hashes'] == hashes:  # touched but not modified
+            save_snapshot(filename, stats, hashes, snapshot['experiment'])
+            return snapshot['experiment']
+
+    experiment = compile_experiment(config)
+    hashes = [file_hash(path) for path, _, _ in stats]
+    save_snapshot(filename, stats, hashes, experiment)
+    return experiment
+
+
+def save_snapshot(filename, stats, hashes, experiment):
+    temp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp, 'wb') as f:
+        pickle.dump(
+            dict(version=SNAPSHOT_VERSION,
+                 stats=stats,
+                 hashes=hashes,
+                 experiment=experiment), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, filename)
+
+
+class ExperimentReloader():
+    '''
+    Poll the sources every interval seconds and re-parse only the changed
+    ones. The new experiment replaces loaded, together with its version,
+    atomically once it passes validation. Until then the last valid
+    experiment keeps being served. Read loaded once to get an experiment
+    and the version that matches it. interval <= 0 disables polling.
+    '''
+    def __init__(self, config, experiment, interval=0, on_reload=None):
+        self.config = {key: config[key] for key in SOURCES}
+        self.on_reload = on_reload
+        self._fields = experiment._asdict()
+        self._stats = self._source_stats()
+        self.loaded = LoadedExperiment(experiment, self._version())
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if interval > 0:
+            thread = threading.Thread(target=self._run,
+                                      args=(interval, ),
+                                      daemon=True)
+            thread.start()
+
+    @property
+    def current(self):
+        return self.loaded.experiment
+
+    @property
+    def version(self):
+        return self.loaded.version
+
+    def _source_stats(self):
+        return dict(zip(SOURCES, source_stats(self.config)))
+
+    def _version(self):
+        '''
+        Identifies the sources the current experiment was loaded from,
+        consistently across processes.
+        '''
+        key = repr(sorted(self._stats.items())).encode('utf8')
+        return hashlib.sha1(key).hexdigest()[:16]
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.check()
+            except Exception as e:
+                print('Failed to reload the experiment:', e)
+
+    def check(self):
+        '''
+        Reload the changed sources.
+        Returns True if the current experiment was replaced.
+        '''
+        with self._lock:
+            stats = self._source_stats()
+            changed = [
+                key for key in SOURCES if stats[key] != self._stats[key]
+            ]
+            if not changed:
+                return False
+            for key in changed:
+                self._fields.update(LOADERS[key](self.config[key]))
+            self._stats = stats
+            try:
+                experiment = build_experiment(self._fields)
+            except AssertionError:
+                print('Invalid experiment after changes in', changed)
+                return False
+            self.loaded = LoadedExperiment(experiment, self._version())
+        print('Reloaded', ', '.join(changed))
+        if self.on_reload is not None:
+            self.on_reload(experiment)
+        return True
+
+    def stop(self):
+        self._stop.set()
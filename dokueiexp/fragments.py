@@ -0,0 +1,83 @@
+'''
+Static parts of the case page rendered once per experiment.
+Only the per-record values are filled in per request.
+'''
+from markupsafe import Markup, escape
+
+REF_VALUE, VALUE, NOTSET = range(3)
+
+
+class CaseFragments():
+    def __init__(self, slider_groups, diagnosis_items):
+        self._slider_parts = self._compile_sliders(slider_groups)
+        self._options = [
+            (Markup('<option value="{0}" selected>{1}</option>').format(
+                idx,
+                diag.item), Markup('<option value="{0}" >{1}</option>').format(
+                    idx, diag.item))
+            for idx, diag in enumerate(diagnosis_items)
+        ]
+        self.diagnosis_descriptions = Markup('').join(
+            Markup('<li>{}</li>').format(diag.description)
+            for diag in diagnosis_items)
+
+    @staticmethod
+    def _compile_sliders(slider_groups):
+        '''
+        Flatten the slider markup into static strings and
+        (kind, label_id) placeholders.
+        '''
+        parts = []
+        for slider_group in slider_groups.values():
+            parts.append(Markup('<div class="sliders">'))
+            for slider in slider_group:
+                parts.append(
+                    Markup('<div class="grid"><label for="{0}">{1}</label>'
+                           '<div style="margin:0 .5em 0 .5em;">').format(
+                               slider.label_id, slider.label))
+                parts.append((REF_VALUE, slider.label_id))
+                parts.append(
+                    Markup('</div><div><div class="label"><span>{1}</span> '
+                           '<span>{2}</span></div><div class="slider">'
+                           '<input type="range" id="{0}" name="{0}" '
+                           'min="0" max="100" value=').format(
+                               slider.label_id, slider.label_left,
+                               slider.label_right))
+                parts.append((VALUE, slider.label_id))
+                parts.append((NOTSET, slider.label_id))
+                parts.append(
+                    Markup('{} onClick="handleChange(this)" '
+                           'onTouchEnd="handleChange(this)" disabled>'
+                           '</div></div></div>').format(
+                               '' if slider.
+                               allow_center else Markup(' data-nocenter')))
+            parts.append(Markup('</div>'))
+        # merge adjacent static strings
+        merged = []
+        for part in parts:
+            if isinstance(part, str) and merged and isinstance(
+                    merged[-1], str):
+                merged[-1] += part
+            else:
+                merged.append(part)
+        return merged
+
+    def sliders(self, data, ref_data):
+        html = []
+        for part in self._slider_parts:
+            if isinstance(part, str):
+                html.append(part)
+                continue
+            kind, label_id = part
+            if kind == REF_VALUE:
+                html.append(escape(ref_data.get(label_id, '')))
+            elif kind == VALUE:
+                html.append(escape(data.get(label_id, 50)))
+            elif label_id not in data:
+                html.append(' class="notset"')
+        return Markup(''.join(html))
+
+    def diagnosis_options(self, data):
+        selected = data.get('diagnosis')
+        return Markup(''.join(option[0] if idx == selected else option[1]
+                              for idx, option in enumerate(self._options)))
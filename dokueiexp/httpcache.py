@@ -0,0 +1,79 @@
+'''
+Conditional GET with ETags and response compression.
+'''
+import gzip
+import hashlib
+import os
+
+import flask
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bump when the pages change in a way not captured by the etag parts; a
+# deploy of new templates or static files is caught by assets_version
+ETAG_VERSION = 2
+
+COMPRESSIBLE_MIMETYPES = {'text/html', 'application/json', 'text/css'}
+
+
+def make_etag(*parts):
+    key = repr((ETAG_VERSION, ) + parts).encode('utf8')
+    return hashlib.sha1(key).hexdigest()
+
+
+def assets_version(*folders):
+    '''
+    The names and mtimes of the files in folders, to tell deploys of the
+    templates and static files apart in the etags of pages.
+    '''
+    return sorted((entry.path, entry.stat().st_mtime_ns) for folder in folders
+                  for entry in os.scandir(folder) if entry.is_file())
+
+
+def conditional(etag, render):
+    '''
+    Return 304 if the client has the page with etag, otherwise render().
+    Pages with pending flash messages are always rendered.
+    '''
+    if '_flashes' in flask.session:
+        return render()
+    if flask.request.if_none_match.contains_weak(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.make_response(render())
+    # weak, so that compressed and uncompressed responses share the etag
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+
+def accepted_encoding(request):
+    accept = request.accept_encodings
+    if brotli is not None and accept['br']:
+        return 'br'
+    if accept['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(response, request, min_size=500, level=6):
+    if (response.status_code != 200 or response.direct_passthrough
+            or response.is_streamed
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding(request)
+    data = response.get_data()
+    if encoding is None or len(data) < min_size:
+        return response
+    if encoding == 'br':
+        data = brotli.compress(data, quality=min(level, 11))
+    else:
+        data = gzip.compress(data, compresslevel=level)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
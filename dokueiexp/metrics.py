@@ -0,0 +1,161 @@
+'''
+Opt-in request and database instrumentation exposed in the
+Prometheus text format.
+'''
+import bisect
+import threading
+import time
+
+import flask
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                   2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf', ), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                name, labels, bound, cumulative))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, self.count))
+        return lines
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _current():
+    if flask.has_request_context():
+        return flask.g.get('metrics')
+    return None
+
+
+# registered once for all the sessions of the process, the engine of the
+# instrumented app is told apart by the request
+@sqlalchemy.event.listens_for(Session, 'before_commit')
+def _before_commit(session):
+    current = _current()
+    if current is not None and session.bind is current['engine']:
+        session.info['metrics_commit_start'] = time.perf_counter()
+
+
+@sqlalchemy.event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    start = session.info.pop('metrics_commit_start', None)
+    current = _current()
+    if start is not None and current is not None:
+        current['commit_seconds'] += time.perf_counter() - start
+
+
+class Metrics():
+    '''
+    Per route request latency, DB queries per request, time spent in
+    the DB and in commits.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.queries = {}
+        self.requests = {}
+        self.db_seconds = {}
+        self.commit_seconds = {}
+
+    def init_app(self, app, engine):
+        self.engine = engine
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                self._before_execute)
+        sqlalchemy.event.listen(engine, 'after_cursor_execute',
+                                self._after_execute)
+
+    def _before_request(self):
+        flask.g.metrics = dict(engine=self.engine,
+                               start=time.perf_counter(),
+                               queries=0,
+                               db_seconds=0,
+                               commit_seconds=0)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        # on the execution context: after_cursor_execute is skipped when
+        # the statement raises, and the context goes away with it
+        context._metrics_start = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        elapsed = time.perf_counter() - context._metrics_start
+        current = _current()
+        if current is not None:
+            current['queries'] += 1
+            current['db_seconds'] += elapsed
+
+    def _after_request(self, response):
+        current = _current()
+        if current is None:
+            return response
+        elapsed = time.perf_counter() - current['start']
+        rule = flask.request.url_rule
+        route = rule.rule if rule is not None else 'unmatched'
+        key = (route, flask.request.method)
+        with self._lock:
+            self.latency.setdefault(
+                key, Histogram(LATENCY_BUCKETS)).observe(elapsed)
+            self.queries.setdefault(key, Histogram(QUERY_BUCKETS)).observe(
+                current['queries'])
+            status_key = key + (response.status_code, )
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            self.db_seconds[key] = self.db_seconds.get(
+                key, 0) + current['db_seconds']
+            self.commit_seconds[key] = self.commit_seconds.get(
+                key, 0) + current['commit_seconds']
+        return response
+
+    def render(self):
+        def labels(route, method):
+            return 'route="{}",method="{}"'.format(escape_label(route), method)
+
+        lines = []
+        with self._lock:
+            lines.append('# TYPE dokueiexp_requests_total counter')
+            for (route, method,
+                 status), count in sorted(self.requests.items()):
+                lines.append(
+                    'dokueiexp_requests_total{{{},status="{}"}} {}'.format(
+                        labels(route, method), status, count))
+            lines.append('# TYPE dokueiexp_request_duration_seconds histogram')
+            for key, histogram in sorted(self.latency.items()):
+                lines += histogram.render('dokueiexp_request_duration_seconds',
+                                          labels(*key))
+            lines.append('# TYPE dokueiexp_request_db_queries histogram')
+            for key, histogram in sorted(self.queries.items()):
+                lines += histogram.render('dokueiexp_request_db_queries',
+                                          labels(*key))
+            for name, values in [
+                ('dokueiexp_db_seconds_total', self.db_seconds),
+                ('dokueiexp_db_commit_seconds_total', self.commit_seconds)
+            ]:
+                lines.append('# TYPE {} counter'.format(name))
+                for key, value in sorted(values.items()):
+                    lines.append('{}{{{}}} {}'.format(name, labels(*key),
+                                                      value))
+        return '\n'.join(lines) + '\n'
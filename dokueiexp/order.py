@@ -0,0 +1,106 @@
+import random
+import threading
+from array import array
+
+from .cache import LRUCache
+
+
+class CaseOrder():
+    '''
+    Permutation of the case ids as an array of indices, with a cursor per
+    w/wo to the first case that may still be unread.
+    seed None keeps the original order.
+    '''
+    def __init__(self, case_ids, seed=None):
+        self.case_ids = case_ids
+        self.seed = seed
+        n = len(case_ids)
+        if seed is None:
+            indices = range(n)
+        else:  # the same order as random.Random(seed).sample(case_ids, n)
+            indices = random.Random(seed).sample(range(n), n)
+        self.indices = array('I', indices)
+        self.cursors = [0, 0]
+        self._positions = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, pos):
+        return self.case_ids[self.indices[pos]]
+
+    def page(self, page, page_size):
+        '''
+        Case ids on the page (starting from 1). page_size <= 0 for all.
+        '''
+        if page_size <= 0:
+            return [self.case_ids[idx] for idx in self.indices]
+        start = (page - 1) * page_size
+        return [
+            self.case_ids[idx] for idx in self.indices[start:start + page_size]
+        ]
+
+    def n_pages(self, page_size):
+        if page_size <= 0:
+            return 1
+        return max(1, -(-len(self) // page_size))
+
+    def _position(self, case_id):
+        if self._positions is None:
+            self._positions = {
+                self.case_ids[idx]: pos
+                for pos, idx in enumerate(self.indices)
+            }
+        return self._positions.get(case_id)
+
+    def first(self, case_ids):
+        '''
+        The case id among case_ids that comes first in the order, or None.
+        '''
+        with self._lock:
+            positions = [(self._position(case_id), case_id)
+                         for case_id in case_ids]
+        positions = [p for p in positions if p[0] is not None]
+        return min(positions)[1] if positions else None
+
+    def _count_before(self, case_ids, pos):
+        count = 0
+        for case_id in case_ids:
+            position = self._position(case_id)
+            if position is not None and position < pos:
+                count += 1
+        return count
+
+    def next_unread(self, ai, done_ids):
+        '''
+        First case id in the order that is not in done_ids, or None.
+        The cursor moves forward and is checked against done_ids, which may
+        have lost cases (unfixed or removed, possibly by another process),
+        so it rescans from the start only when it skipped one of them.
+        '''
+        with self._lock:
+            pos = self.cursors[int(ai)]
+            if self._count_before(done_ids, pos) < pos:
+                pos = 0
+            while pos < len(self) and self[pos] in done_ids:
+                pos += 1
+            self.cursors[int(ai)] = pos
+        return self[pos] if pos < len(self) else None
+
+
+class CaseOrders():
+    '''
+    CaseOrder of each user, computed once per login seed and experiment
+    version.
+    '''
+    def __init__(self, maxsize=256):
+        self._orders = LRUCache(maxsize, ttl=float('inf'))
+
+    def get(self, username, case_ids, seed, version):
+        key = (seed, version)
+        entry = self._orders.get(username)
+        if entry is None or entry[0] != key:
+            entry = (key, CaseOrder(case_ids, seed))
+            self._orders.set(username, entry)
+        return entry[1]
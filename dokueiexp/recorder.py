@@ -1,38 +1,234 @@
+import csv
+import io
 import json
+import random
+import time
+from collections import namedtuple
 
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Boolean, String, DateTime, Integer
+from sqlalchemy import Column, Boolean, String, DateTime, Integer, Index, func
 from sqlalchemy.orm import sessionmaker, Session
 
 import datetime
-import pandas as pd
+
+from .codec import decode_json, encode_json
 
 Base = declarative_base()
 
 
 def record_data2obj(data):
-    return json.loads(data.decode('utf8'))
+    return decode_json(data)
+
+
+CSV_COLUMNS = [
+    'username', 'case_id', 'ai', 'last_update', 'elapsed_time', 'data',
+    'completed'
+]
+JOURNAL_COLUMNS = [
+    'username', 'case_id', 'ai', 'data', 'elapsed_time', 'completed',
+    'last_update'
+]
+BULK_OPERATIONS = ['unfix', 'reset', 'reassign']
+# key of the diagnosis option index in the record data, beside the items
+DIAGNOSIS_KEY = 'diagnosis'
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_BUFFER_SIZE = 64 * 1024
+# A write may commit after an export computed its watermark while its
+# last_update is earlier (it waited for the lock). Incremental exports
+# start this much before since, so consecutive pulls overlap.
+EXPORT_OVERLAP = datetime.timedelta(seconds=10)
+IMPORT_CHUNK_SIZE = 10000
+
+# Storage profiles selectable with the STORAGE_PROFILE config
+STORAGE_PROFILES = {
+    'default': {},
+    # for several threads writing to the same sqlite database
+    'concurrent':
+    dict(journal_mode='WAL',
+         synchronous='NORMAL',
+         busy_timeout=5000,
+         pool_size=8,
+         max_overflow=8,
+         retries=8,
+         retry_backoff=0.01),
+}
+
+RecordState = namedtuple(
+    'RecordState',
+    ['username', 'case_id', 'ai', 'completed', 'last_update', 'elapsed_time'])
 
 
 class RecordDB():
-    def __init__(self, filename, echo=False):
-        self.engine = sqlalchemy.create_engine(filename, echo=echo)
+    def __init__(self,
+                 filename,
+                 echo=False,
+                 progress_counters=False,
+                 profile='default',
+                 normalize_values=False,
+                 journal=False,
+                 codec=None,
+                 migrate=True):
+        self.profile = dict(STORAGE_PROFILES[profile])
+        self.engine = self._create_engine(filename, echo, self.profile)
+        fresh = not sqlalchemy.inspect(self.engine).has_table('records')
         Base.metadata.create_all(bind=self.engine)
+        if fresh:  # created with the latest schema
+            self._stamp_schema(range(1, SCHEMA_VERSION + 1))
+        if migrate:
+            self.migrate()
         self.session = sessionmaker(bind=self.engine)()
+        self.progress_counters = progress_counters
+        self.normalize_values = normalize_values
+        self.journal = journal
+        self.codec = codec
+        self.listeners = []
+        if journal:
+            with self.new_session() as sess:
+                self._seed_journal(sess)
+        with self.new_session() as sess:
+            self._backfill('progress', progress_counters,
+                           lambda: self._recount_progress(sess), sess)
+            self._backfill('record_values', normalize_values,
+                           lambda: self._rebuild_values(sess), sess)
 
     def new_session(self):
         return Session(self.engine)
 
+    def _backfill(self, name, enabled, rebuild, sess):
+        '''
+        Build the derived table from the records table once. Writes keep
+        it up to date afterwards, so it is marked as built until a process
+        runs without maintaining it.
+        '''
+        marker = self.DerivedTable.__table__
+        if not enabled:
+            sess.execute(
+                sqlalchemy.delete(marker).where(marker.c.name == name))
+            sess.commit()
+            return
+        if sess.get(self.DerivedTable, name) is not None:
+            return
+        try:
+            # the marker is inserted first so that the write lock or the
+            # primary key makes the other processes wait for this rebuild
+            # and skip theirs
+            sess.execute(sqlalchemy.insert(marker),
+                         dict(name=name, built=datetime.datetime.now()))
+            rebuild()
+            sess.commit()
+        except sqlalchemy.exc.IntegrityError:
+            sess.rollback()  # built by another process
+        except sqlalchemy.exc.OperationalError as e:
+            sess.rollback()
+            if 'locked' not in str(e):
+                raise
+            # still being built by the process holding the lock
+
+    def schema_version(self):
+        with self.engine.connect() as conn:
+            version = conn.execute(
+                sqlalchemy.select(func.max(
+                    self.SchemaVersion.version))).scalar()
+        return version or 0
+
+    def check_schema(self):
+        '''
+        Raise RuntimeError if there are pending migrations.
+        '''
+        version = self.schema_version()
+        if version < SCHEMA_VERSION:
+            raise RuntimeError(
+                'The database schema is at version {} (latest: {}). '
+                'Run "recorder migrate".'.format(version, SCHEMA_VERSION))
+
+    def _stamp_schema(self, versions):
+        rows = [
+            dict(version=version, applied=datetime.datetime.now())
+            for version in versions
+        ]
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(sqlalchemy.insert(self.SchemaVersion.__table__),
+                             rows)
+        except sqlalchemy.exc.IntegrityError:
+            pass  # stamped by another process
+
+    def migrate(self):
+        '''
+        Apply the pending schema migrations in order, each in its own
+        transaction. Returns the applied versions.
+        '''
+        applied = []
+        for version in range(self.schema_version() + 1, SCHEMA_VERSION + 1):
+            try:
+                with self.engine.begin() as conn:
+                    MIGRATIONS[version - 1](conn)
+                    conn.execute(
+                        sqlalchemy.insert(self.SchemaVersion.__table__),
+                        dict(version=version, applied=datetime.datetime.now()))
+            except sqlalchemy.exc.IntegrityError:
+                continue  # applied by another process
+            applied.append(version)
+        return applied
+
+    @staticmethod
+    def _create_engine(filename, echo, profile):
+        url = sqlalchemy.engine.make_url(filename)
+        if url.get_backend_name() != 'sqlite' or not profile:
+            return sqlalchemy.create_engine(filename, echo=echo)
+
+        engine = sqlalchemy.create_engine(
+            filename,
+            echo=echo,
+            poolclass=sqlalchemy.pool.QueuePool,
+            pool_size=profile['pool_size'],
+            max_overflow=profile['max_overflow'],
+            connect_args=dict(check_same_thread=False,
+                              timeout=profile['busy_timeout'] / 1000))
+
+        @sqlalchemy.event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode={}'.format(
+                profile['journal_mode']))
+            cursor.execute('PRAGMA synchronous={}'.format(
+                profile['synchronous']))
+            cursor.execute('PRAGMA busy_timeout={}'.format(
+                profile['busy_timeout']))
+            cursor.close()
+
+        return engine
+
+    def _retry_on_lock(self, write, sess):
+        '''
+        Run write(sess) and retry with exponential backoff
+        if the database is locked.
+        '''
+        retries = self.profile.get('retries', 0)
+        for attempt in range(retries + 1):
+            try:
+                return write(sess)
+            except sqlalchemy.exc.OperationalError as e:
+                sess.rollback()
+                if 'locked' not in str(e) or attempt == retries:
+                    raise
+                time.sleep(self.profile['retry_backoff'] * 2**attempt *
+                           random.uniform(1, 2))
+
     class Record(Base):
         __tablename__ = "records"
         username = Column(String(length=64), primary_key=True)
         case_id = Column(String(length=64), primary_key=True)
         data = Column(String(length=1024))
         elapsed_time = Column(Integer())
-        last_update = Column(DateTime())
+        last_update = Column(DateTime(), index=True)
         ai = Column(Boolean(), primary_key=True)
         completed = Column(Boolean())
+        # dashboard and progress by user, selections by case across users
+        __table_args__ = (Index('ix_records_username_completed', 'username',
+                                'completed', 'ai'),
+                          Index('ix_records_case_id', 'case_id', 'ai'))
 
         def __init__(self, username: str, case_id: str, data: str,
                      elapsed_time: int, ai: bool, completed: bool):
@@ -44,8 +240,8 @@ class RecordDB():
             self.elapsed_time = elapsed_time
             self.last_update = datetime.datetime.now()
 
-        def to_dict(self):
-            data = record_data2obj(self.data)
+        def to_dict(self, decode=record_data2obj):
+            data = decode(self.data)
             return dict(username=self.username,
                         case_id=self.case_id,
                         ai=self.ai,
@@ -54,11 +250,198 @@ class RecordDB():
                         data=json.dumps(data),
                         completed=self.completed)
 
+    class Progress(Base):
+        '''
+        Number of records per (username, ai, completed).
+        Maintained by update_record when progress_counters is enabled.
+        '''
+        __tablename__ = "progress"
+        username = Column(String(length=64), primary_key=True)
+        ai = Column(Boolean(), primary_key=True)
+        completed = Column(Boolean(), primary_key=True)
+        count = Column(Integer(), nullable=False, default=0)
+
+    class RecordValue(Base):
+        '''
+        Numeric values in Record.data, one row per item.
+        Maintained by update_record when normalize_values is enabled.
+        '''
+        __tablename__ = "record_values"
+        username = Column(String(length=64), primary_key=True)
+        case_id = Column(String(length=64), primary_key=True)
+        ai = Column(Boolean(), primary_key=True)
+        item_id = Column(String(length=64), primary_key=True)
+        value = Column(Integer())
+        __table_args__ = (Index('ix_record_values_item', 'item_id', 'ai',
+                                'value'), )
+
+    class JournalEntry(Base):
+        '''
+        Every write of a record, appended in the same transaction.
+        A record removed by bulk_update ends with a tombstone entry whose
+        completed and data are NULL.
+        Maintained by update_record when journal is enabled.
+        '''
+        __tablename__ = "journal"
+        id = Column(Integer(), primary_key=True, autoincrement=True)
+        username = Column(String(length=64), nullable=False)
+        case_id = Column(String(length=64), nullable=False)
+        ai = Column(Boolean(), nullable=False)
+        data = Column(String(length=1024))
+        elapsed_time = Column(Integer())
+        completed = Column(Boolean())
+        last_update = Column(DateTime())
+        __table_args__ = (Index('ix_journal_key', 'username', 'case_id', 'ai',
+                                'id'), )
+
+    class SchemaVersion(Base):
+        '''
+        Applied schema migrations.
+        '''
+        __tablename__ = "schema_version"
+        version = Column(Integer(), primary_key=True, autoincrement=False)
+        applied = Column(DateTime())
+
+    class DerivedTable(Base):
+        '''
+        Derived tables that were built from the records table and have been
+        maintained by every write since.
+        '''
+        __tablename__ = "derived_tables"
+        name = Column(String(length=64), primary_key=True)
+        built = Column(DateTime())
+
+    class LoginState(Base):
+        '''
+        Seed of the case order of each user, set at login.
+        '''
+        __tablename__ = "login_states"
+        username = Column(String(length=64), primary_key=True)
+        seed = Column(Integer(), nullable=False)
+        login_at = Column(DateTime())
+
+    def add_listener(self, listener):
+        '''
+        listener is called with a list of RecordState after each commit.
+        '''
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def _notify(self, states):
+        for listener in self.listeners:
+            listener(states)
+
+    def encode_data(self, obj):
+        '''
+        Encode record data with the codec, JSON if there is none.
+        '''
+        if self.codec is None:
+            return encode_json(obj)
+        return self.codec.encode(obj)
+
+    def decode_data(self, data):
+        if self.codec is None:
+            return record_data2obj(data)
+        return self.codec.decode(data)
+
+    def recode_records(self,
+                       encode=None,
+                       sess=None,
+                       chunk_size=IMPORT_CHUNK_SIZE):
+        '''
+        Re-encode the data of every record and journal entry with encode
+        (encode_data if None), e.g. to migrate existing JSON rows after
+        enabling the codec. Returns the number of rewritten rows.
+        '''
+        if encode is None:
+            encode = self.encode_data
+        if sess is None:
+            sess = self.session
+        count = 0
+        for cls, keys in [(self.Record, ['username', 'case_id', 'ai']),
+                          (self.JournalEntry, ['id'])]:
+            table = cls.__table__
+            stmt = table.update().where(*[
+                table.c[key] == sqlalchemy.bindparam('_' + key) for key in keys
+            ]).values(data=sqlalchemy.bindparam('_data'))
+            rows = sess.execute(
+                sqlalchemy.select(*[table.c[key] for key in keys],
+                                  table.c.data)).fetchall()
+            for start in range(0, len(rows), chunk_size):
+                params = []
+                for row in rows[start:start + chunk_size]:
+                    row = row._asdict()
+                    data = encode(self.decode_data(row['data']))
+                    if data != row['data']:
+                        params.append({
+                            '_' + key: value
+                            for key, value in dict(row, data=data).items()
+                        })
+                if params:
+                    sess.execute(stmt, params)
+                    sess.commit()
+                    count += len(params)
+        return count
+
     def get_record(self, username, case_id, ai, sess=None):
         if sess is None:
             sess = self.session
         return sess.query(self.Record).get((username, case_id, ai))
 
+    def _dialect_insert(self):
+        '''
+        insert() of the dialect if it supports ON CONFLICT DO UPDATE
+        or None.
+        '''
+        dialect = self.engine.dialect.name
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        elif dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            return None
+        return insert
+
+    def _upsert_statement(self, keep_completed=False):
+        '''
+        Dialect-native INSERT ... ON CONFLICT DO UPDATE or None if
+        the dialect has no support for it.
+        keep_completed leaves completed records as they are.
+        '''
+        insert = self._dialect_insert()
+        if insert is None:
+            return None
+        table = self.Record.__table__
+        stmt = insert(table)
+        return stmt.on_conflict_do_update(
+            index_elements=['username', 'case_id', 'ai'],
+            set_={
+                name: stmt.excluded[name]
+                for name in
+                ['data', 'elapsed_time', 'last_update', 'completed']
+            },
+            where=sqlalchemy.not_(table.c.completed)
+            if keep_completed else None)
+
+    def _merge_record(self, values, sess, keep_completed=False):
+        match = sess.query(self.Record).get(
+            (values['username'], values['case_id'], values['ai']))
+        if match and keep_completed and match.completed:
+            return
+        if match:
+            match.last_update = values['last_update']
+            match.data = values['data']
+            match.elapsed_time = values['elapsed_time']
+            match.completed = values['completed']
+        else:
+            record = self.Record(values['username'], values['case_id'],
+                                 values['data'], values['elapsed_time'],
+                                 values['ai'], values['completed'])
+            record.last_update = values['last_update']
+            sess.add(instance=record)
+
     def update_record(self,
                       username: str,
                       case_id: str,
@@ -67,76 +450,861 @@ class RecordDB():
                       ai: bool,
                       completed: bool,
                       sess=None):
+        self.update_records([
+            dict(username=username,
+                 case_id=case_id,
+                 data=data,
+                 elapsed_time=elapsed_time,
+                 ai=ai,
+                 completed=completed)
+        ], sess)
+
+    def update_records(self, rows, sess=None, keep_completed=False):
+        '''
+        Insert or update records in a single transaction.
+        rows: list of dicts with username, case_id, data, elapsed_time,
+        ai and completed.
+        keep_completed skips the rows whose record is completed, so that a
+        late draft cannot reopen a fixed record.
+        '''
         if sess is None:
             sess = self.session
-        record = self.Record(username, case_id, data, elapsed_time, ai,
-                             completed)
-        match = sess.query(self.Record).get(
-            (record.username, record.case_id, record.ai))
-        if match:
-            match.last_update = datetime.datetime.now()
-            match.data = record.data
-            match.elapsed_time = elapsed_time
-            match.completed = record.completed
-            sess.commit()
+        rows = self._retry_on_lock(
+            lambda sess: self._write_records(rows, sess, keep_completed), sess)
+        self._notify([
+            RecordState(row['username'], row['case_id'], row['ai'],
+                        row['completed'], row['last_update'],
+                        row['elapsed_time']) for row in rows
+        ])
+
+    def _write_records(self, rows, sess, keep_completed=False):
+        # stamped in each attempt, as close to the commit as possible
+        now = datetime.datetime.now()
+        rows = [
+            dict(row,
+                 ai=bool(row['ai']),
+                 completed=bool(row['completed']),
+                 last_update=now) for row in rows
+        ]
+        stmt = self._upsert_statement(keep_completed)
+        if stmt is None:
+            for row in rows:
+                self._merge_record(row, sess, keep_completed)
         else:
-            sess.add(instance=record)
-            sess.commit()
+            sess.execute(stmt, rows)
+        if keep_completed:
+            Record = self.Record
+            completed = set(
+                sess.query(Record.username, Record.case_id, Record.ai).filter(
+                    sqlalchemy.tuple_(Record.username, Record.case_id,
+                                      Record.ai).in_([
+                                          (row['username'], row['case_id'],
+                                           row['ai']) for row in rows
+                                      ]), Record.completed))
+            rows = [
+                row for row in rows
+                if (row['username'], row['case_id'],
+                    row['ai']) not in completed or row['completed']
+            ]
+        if self.normalize_values:
+            for row in rows:
+                sess.query(self.RecordValue).filter_by(
+                    username=row['username'],
+                    case_id=row['case_id'],
+                    ai=row['ai']).delete()
+            self._insert_values(rows, sess)
+        if self.journal:
+            sess.execute(sqlalchemy.insert(self.JournalEntry.__table__), rows)
+        if self.progress_counters:
+            # counted after the records are written, in the same transaction
+            self._recount_progress(sess, {row['username'] for row in rows})
+        sess.commit()
+        return rows
+
+    def _seed_journal(self, sess):
+        '''
+        Start an empty journal from the existing records so that
+        replaying it does not lose them.
+        '''
+        if sess.query(self.JournalEntry.id).first() is not None:
+            return
+        self._journal_records(sess)
+        sess.commit()
+
+    def _journal_records(self, sess):
+        '''
+        Append the records that are newer than their latest journal entry,
+        or have none, e.g. written while the journal was disabled.
+        Returns the number of appended entries.
+        '''
+        entry = self.JournalEntry
+        journaled = sqlalchemy.exists().where(
+            entry.username == self.Record.username,
+            entry.case_id == self.Record.case_id, entry.ai == self.Record.ai,
+            entry.last_update >= self.Record.last_update)
+        columns = [getattr(self.Record, name) for name in JOURNAL_COLUMNS]
+        result = sess.execute(
+            sqlalchemy.insert(entry.__table__).from_select(
+                JOURNAL_COLUMNS,
+                sqlalchemy.select(*columns).where(~journaled).order_by(
+                    self.Record.last_update)))
+        return result.rowcount
+
+    def _latest_entries(self):
+        '''
+        Subquery of the id of the latest journal entry per record.
+        '''
+        return sqlalchemy.select(func.max(
+            self.JournalEntry.id).label('id')).group_by(
+                self.JournalEntry.username, self.JournalEntry.case_id,
+                self.JournalEntry.ai).subquery()
+
+    def journal_history(self, username, case_id, ai, sess=None):
+        '''
+        Journal entries of the record, oldest first.
+        '''
+        if sess is None:
+            sess = self.session
+        return sess.query(self.JournalEntry).filter_by(
+            username=username, case_id=case_id,
+            ai=bool(ai)).order_by(self.JournalEntry.id).all()
+
+    def replay_journal(self, sess=None):
+        '''
+        Rebuild the records table from the latest journal entry of each
+        record, unless it is a tombstone, then the derived tables. Records
+        newer than their latest entry are journaled first so that they are
+        kept.
+        Returns the number of records.
+        '''
+        if sess is None:
+            sess = self.session
+        self._journal_records(sess)
+        latest = self._latest_entries()
+        columns = [
+            getattr(self.JournalEntry, name) for name in JOURNAL_COLUMNS
+        ]
+        sess.query(self.Record).delete()
+        result = sess.execute(
+            sqlalchemy.insert(self.Record.__table__).from_select(
+                JOURNAL_COLUMNS,
+                sqlalchemy.select(*columns).join(
+                    latest, self.JournalEntry.id == latest.c.id).where(
+                        self.JournalEntry.completed.is_not(None))))
+        sess.commit()
+        if self.progress_counters:
+            self.rebuild_progress(sess)
+        if self.normalize_values:
+            self.rebuild_values(sess)
+        return result.rowcount
 
-    def to_csv(self, filename, sess=None):
+    def compact_journal(self, before=None, sess=None):
+        '''
+        Delete journal entries older than before (all if None) that are
+        superseded by a later entry of the same record. The latest entry of
+        each record is kept so that replay_journal still works.
+        Returns the number of deleted entries.
+        '''
         if sess is None:
             sess = self.session
-        rows = []
-        for r in sess.query(self.Record):
-            rows.append(r.to_dict())
+        latest = sqlalchemy.select(self._latest_entries().c.id)
+        query = sess.query(self.JournalEntry).filter(
+            self.JournalEntry.id.not_in(latest))
+        if before is not None:
+            query = query.filter(self.JournalEntry.last_update < before)
+        count = query.delete(synchronize_session=False)
+        sess.commit()
+        return count
 
-        df = pd.DataFrame(rows)
-        df.to_csv(filename, index=False, encoding='cp932')
+    def _value_rows(self, row):
+        for item_id, value in self.decode_data(row['data']).items():
+            if item_id == DIAGNOSIS_KEY:  # an option index, not a value
+                continue
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                continue
+            yield dict(username=row['username'],
+                       case_id=row['case_id'],
+                       ai=bool(row['ai']),
+                       item_id=item_id,
+                       value=value)
 
-    def from_csv(self, filename, sess=None):
+    def _insert_values(self, rows, sess):
+        value_rows = [v for row in rows for v in self._value_rows(row)]
+        if value_rows:
+            sess.execute(sqlalchemy.insert(self.RecordValue.__table__),
+                         value_rows)
+
+    def rebuild_values(self, sess=None, chunk_size=EXPORT_CHUNK_SIZE):
+        '''
+        Recompute the record_values table from the records table.
+        '''
         if sess is None:
             sess = self.session
-        df = pd.read_csv(filename, encoding='cp932')
-        for _, row in df.iterrows():
-            record = self.Record(row.get('username'), str(row.get('case_id')),
-                                 row.get('data'), int(row.get('elapsed_time')),
-                                 bool(row.get('ai')),
-                                 bool(row.get('completed')))
-            record.last_update = datetime.datetime.fromisoformat(
-                row.get('last_update'))
-            sess.add(instance=record)
+        self._rebuild_values(sess, chunk_size)
+        sess.commit()
+
+    def _rebuild_values(self, sess, chunk_size=EXPORT_CHUNK_SIZE):
+        sess.query(self.RecordValue).delete()
+        rows = sess.query(self.Record.username, self.Record.case_id,
+                          self.Record.ai,
+                          self.Record.data).yield_per(chunk_size)
+        chunk = []
+        for row in rows:
+            chunk.append(row._asdict())
+            if len(chunk) >= chunk_size:
+                self._insert_values(chunk, sess)
+                chunk = []
+        self._insert_values(chunk, sess)
+
+    def item_stats(self, ai=None, completed=True, sess=None):
+        '''
+        Per item count, mean, min and max of the values computed in SQL.
+        Requires normalize_values.
+        '''
+        if sess is None:
+            sess = self.session
+        value = self.RecordValue.value
+        query = sess.query(self.RecordValue.item_id, func.count(value),
+                           func.avg(value), func.min(value), func.max(value))
+        if ai is not None:
+            query = query.filter(self.RecordValue.ai == bool(ai))
+        if completed is not None:
+            query = query.join(
+                self.Record,
+                (self.Record.username == self.RecordValue.username) &
+                (self.Record.case_id == self.RecordValue.case_id) &
+                (self.Record.ai == self.RecordValue.ai)).filter(
+                    self.Record.completed == bool(completed))
+        return {
+            item_id: dict(count=count, mean=mean, min=vmin, max=vmax)
+            for item_id, count, mean, vmin, vmax in query.group_by(
+                self.RecordValue.item_id)
+        }
+
+    def fix_record(self,
+                   username: str,
+                   case_id: str,
+                   data: bytes,
+                   elapsed_time: int,
+                   ai: bool,
+                   sess=None):
+        '''
+        Fix the record. Fixing the record without AI also seeds the draft
+        with AI, atomically in the same transaction.
+        '''
+        rows = [
+            dict(username=username,
+                 case_id=case_id,
+                 data=data,
+                 elapsed_time=elapsed_time,
+                 ai=ai,
+                 completed=True)
+        ]
+        if not ai:
+            rows.append(
+                dict(username=username,
+                     case_id=case_id,
+                     data=data,
+                     elapsed_time=0,
+                     ai=True,
+                     completed=False))
+        self.update_records(rows, sess)
+
+    @staticmethod
+    def _selection(cls, usernames=None, case_ids=None, ai=None):
+        criteria = []
+        if usernames is not None:
+            criteria.append(cls.username.in_(usernames))
+        if case_ids is not None:
+            criteria.append(cls.case_id.in_(case_ids))
+        if ai is not None:
+            criteria.append(cls.ai == bool(ai))
+        return criteria
+
+    def bulk_update(self,
+                    operation,
+                    usernames=None,
+                    case_ids=None,
+                    ai=None,
+                    new_username=None,
+                    sess=None):
+        '''
+        Apply operation to the records selected by usernames, case_ids
+        and ai (None selects all) in one set-based statement and one
+        transaction. Returns the number of affected records.
+            unfix: mark completed records as not completed.
+            reset: delete the records.
+            reassign: move the records to new_username.
+        Listeners get the affected records, removed ones with
+        completed=None.
+        '''
+        if operation not in BULK_OPERATIONS:
+            raise ValueError('Invalid operation: {}'.format(operation))
+        if operation == 'reassign' and not new_username:
+            raise ValueError('reassign needs new_username')
+        if sess is None:
+            sess = self.session
+        count, states = self._retry_on_lock(
+            lambda sess: self._bulk_update(operation, usernames, case_ids, ai,
+                                           new_username, sess), sess)
+        self._notify(states)
+        return count
+
+    def _bulk_update(self, operation, usernames, case_ids, ai, new_username,
+                     sess):
+        now = datetime.datetime.now()
+        criteria = self._selection(self.Record, usernames, case_ids, ai)
+        if operation == 'unfix':
+            criteria.append(self.Record.completed)
+        selected = [
+            RecordState(*row) for row in sess.query(
+                self.Record.username, self.Record.case_id, self.Record.ai,
+                self.Record.completed, self.Record.last_update,
+                self.Record.elapsed_time).filter(*criteria)
+        ]
+        if not selected:
+            sess.rollback()
+            return 0, []
+        keys = sqlalchemy.tuple_(self.Record.username, self.Record.case_id,
+                                 self.Record.ai)
+
+        if operation == 'unfix':
+            sess.query(self.Record).filter(*criteria).update(
+                dict(completed=False, last_update=now),
+                synchronize_session=False)
+            states = [
+                state._replace(completed=False, last_update=now)
+                for state in selected
+            ]
+        else:
+            dependents = [self.Record]
+            if self.normalize_values:
+                dependents.append(self.RecordValue)
+            for cls in dependents:
+                query = sess.query(cls).filter(
+                    *self._selection(cls, usernames, case_ids, ai))
+                if operation == 'reset':
+                    query.delete(synchronize_session=False)
+                elif cls is self.Record:
+                    query.update(dict(username=new_username, last_update=now),
+                                 synchronize_session=False)
+                else:
+                    query.update(dict(username=new_username),
+                                 synchronize_session=False)
+            states = [state._replace(completed=None) for state in selected]
+            if operation == 'reassign':
+                states += [
+                    state._replace(username=new_username, last_update=now)
+                    for state in selected
+                ]
+        if self.journal:
+            # the past entries are kept, a removed record gets a tombstone
+            removed = [state for state in states if state.completed is None]
+            if removed:
+                sess.execute(sqlalchemy.insert(self.JournalEntry.__table__), [
+                    dict(username=state.username,
+                         case_id=state.case_id,
+                         ai=state.ai,
+                         last_update=now) for state in removed
+                ])
+            written = [
+                state[:3] for state in states if state.completed is not None
+            ]
+            if written:
+                columns = [
+                    getattr(self.Record, name) for name in JOURNAL_COLUMNS
+                ]
+                sess.execute(
+                    sqlalchemy.insert(self.JournalEntry.__table__).from_select(
+                        JOURNAL_COLUMNS,
+                        sqlalchemy.select(*columns).where(keys.in_(written))))
+        if self.progress_counters:
+            affected = {state.username for state in states}
+            self._recount_progress(sess, affected)
         sess.commit()
+        return len(selected), states
 
+    def _aggregate_progress(self, sess):
+        return sess.query(self.Record.username, self.Record.ai,
+                          self.Record.completed,
+                          func.count()).group_by(self.Record.username,
+                                                 self.Record.ai,
+                                                 self.Record.completed)
 
-def main():
+    def rebuild_progress(self, sess=None):
+        '''
+        Recompute the progress table from the records table.
+        '''
+        if sess is None:
+            sess = self.session
+        self._recount_progress(sess)
+        sess.commit()
+
+    def _recount_progress(self, sess, usernames=None):
+        '''
+        Set the counters of the users (all if None) from the records table
+        with set-based statements, so that concurrent writers for the same
+        user cannot lose each other's counts.
+        '''
+        table = self.Progress.__table__
+        Record = self.Record
+        counts = sqlalchemy.select(Record.username, Record.ai,
+                                   Record.completed, func.count()).group_by(
+                                       Record.username, Record.ai,
+                                       Record.completed)
+        reset = table.update().values(count=0)
+        if usernames is not None:
+            counts = counts.where(Record.username.in_(usernames))
+            reset = reset.where(table.c.username.in_(usernames))
+        else:  # sqlite needs a WHERE to parse INSERT ... SELECT ... ON CONFLICT
+            counts = counts.where(sqlalchemy.true())
+        columns = ['username', 'ai', 'completed', 'count']
+        insert = self._dialect_insert()
+        if insert is None:
+            delete = table.delete()
+            if usernames is not None:
+                delete = delete.where(table.c.username.in_(usernames))
+            sess.execute(delete)
+            sess.execute(table.insert().from_select(columns, counts))
+            return
+        stmt = insert(table).from_select(columns, counts)
+        sess.execute(reset)
+        sess.execute(
+            stmt.on_conflict_do_update(
+                index_elements=['username', 'ai', 'completed'],
+                set_=dict(count=stmt.excluded['count'])))
+
+    def progress_summary(self, sess=None, usernames=None):
+        '''
+        Number of records keyed by username then (ai, completed), of the
+        users (all if None). Costs a single query regardless of the number
+        of users.
+        '''
+        if sess is None:
+            sess = self.session
+        if self.progress_counters:
+            rows = sess.query(self.Progress.username, self.Progress.ai,
+                              self.Progress.completed, self.Progress.count)
+            cls = self.Progress
+        else:
+            rows = self._aggregate_progress(sess)
+            cls = self.Record
+        if usernames is not None:
+            rows = rows.filter(cls.username.in_(usernames))
+        summary = {}
+        for username, ai, completed, count in rows:
+            if count == 0:
+                continue
+            summary.setdefault(username,
+                               {})[(bool(ai), bool(completed))] = count
+        return summary
+
+    def get_login_seed(self, username, sess=None):
+        if sess is None:
+            sess = self.session
+        return sess.query(
+            self.LoginState.seed).filter_by(username=username).scalar()
+
+    def set_login_seed(self, username, seed, sess=None):
+        if sess is None:
+            sess = self.session
+
+        def write(sess):
+            sess.merge(
+                self.LoginState(username=username,
+                                seed=seed,
+                                login_at=datetime.datetime.now()))
+            sess.commit()
+
+        self._retry_on_lock(write, sess)
+
+    def dashboard_state(self, username, sess=None):
+        '''
+        Record states of the user as dicts of case_id -> RecordState
+        for without AI and with AI.
+        '''
+        if sess is None:
+            sess = self.session
+        rows = sess.query(
+            self.Record.username, self.Record.case_id, self.Record.ai,
+            self.Record.completed, self.Record.last_update,
+            self.Record.elapsed_time).filter_by(username=username)
+        rec_dict, ai_rec_dict = {}, {}
+        for row in rows:
+            state = RecordState(*row)
+            if state.ai:
+                ai_rec_dict[state.case_id] = state
+            else:
+                rec_dict[state.case_id] = state
+        return rec_dict, ai_rec_dict
+
+    def export_watermark(self, since=None, sess=None):
+        '''
+        Latest last_update among records updated after since.
+        since is returned if there is no such record.
+        '''
+        if sess is None:
+            sess = self.session
+        query = sess.query(func.max(self.Record.last_update))
+        if since is not None:
+            query = query.filter(self.Record.last_update > since)
+        watermark = query.scalar()
+        return since if watermark is None else watermark
+
+    def iter_records(self,
+                     sess=None,
+                     chunk_size=EXPORT_CHUNK_SIZE,
+                     since=None,
+                     until=None):
+        '''
+        Iterate over records with since < last_update <= until,
+        fetching chunk_size rows at a time.
+        '''
+        if sess is None:
+            sess = self.session
+        query = sess.query(self.Record)
+        if since is not None:
+            query = query.filter(self.Record.last_update > since)
+        if until is not None:
+            query = query.filter(self.Record.last_update <= until)
+        if since is not None or until is not None:
+            query = query.order_by(self.Record.last_update)
+        return query.yield_per(chunk_size)
+
+    def iter_csv(self,
+                 sess=None,
+                 chunk_size=EXPORT_CHUNK_SIZE,
+                 encoding='cp932',
+                 since=None,
+                 until=None):
+        '''
+        Export records as chunks of encoded csv.
+        '''
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, CSV_COLUMNS, lineterminator='\n')
+        writer.writeheader()
+        for record in self.iter_records(sess, chunk_size, since, until):
+            writer.writerow(record.to_dict(self.decode_data))
+            if buf.tell() > EXPORT_BUFFER_SIZE:
+                yield buf.getvalue().encode(encoding)
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue().encode(encoding)
+
+    def iter_jsonl(self,
+                   sess=None,
+                   chunk_size=EXPORT_CHUNK_SIZE,
+                   since=None,
+                   until=None):
+        '''
+        Export records as chunks of utf8 JSON Lines.
+        '''
+        lines = []
+        size = 0
+        for record in self.iter_records(sess, chunk_size, since, until):
+            row = record.to_dict(self.decode_data)
+            row['last_update'] = row['last_update'].isoformat()
+            row['data'] = json.loads(row['data'])
+            line = json.dumps(row, ensure_ascii=False) + '\n'
+            lines.append(line)
+            size += len(line)
+            if size > EXPORT_BUFFER_SIZE:
+                yield ''.join(lines).encode('utf8')
+                lines = []
+                size = 0
+        yield ''.join(lines).encode('utf8')
+
+    def to_csv(self, filename, sess=None, since=None, overlap=EXPORT_OVERLAP):
+        '''
+        Export records updated after since - overlap (all if since is None).
+        Returns the watermark for the next incremental export.
+        '''
+        if sess is None:
+            sess = self.session
+        watermark = self.export_watermark(since, sess)
+        if since is not None:
+            since = since - overlap
+        with open(filename, 'wb') as f:
+            for chunk in self.iter_csv(sess, since=since, until=watermark):
+                f.write(chunk)
+        return watermark
+
+    def from_csv(self,
+                 filename,
+                 sess=None,
+                 chunk_size=IMPORT_CHUNK_SIZE,
+                 upsert=False):
+        '''
+        Import records from csv, inserting and committing chunk_size rows
+        at a time. Existing records are updated if upsert is True.
+        The imported rows are journaled when journal is enabled.
+        '''
+        import pandas as pd
+        if sess is None:
+            sess = self.session
+        stmt = self._upsert_statement() if upsert else None
+        for df in pd.read_csv(filename,
+                              encoding='cp932',
+                              chunksize=chunk_size,
+                              dtype={
+                                  'username': str,
+                                  'case_id': str,
+                                  'data': str
+                              }):
+            rows = [
+                dict(username=username,
+                     case_id=case_id,
+                     data=data.encode('utf8'),
+                     elapsed_time=int(elapsed_time),
+                     ai=bool(ai),
+                     completed=bool(completed),
+                     last_update=datetime.datetime.fromisoformat(last_update))
+                for username, case_id, data, elapsed_time, ai, completed,
+                last_update in zip(df['username'], df['case_id'], df['data'],
+                                   df['elapsed_time'], df['ai'],
+                                   df['completed'], df['last_update'])
+            ]
+            if stmt is not None:
+                sess.execute(stmt, rows)
+            elif upsert:
+                for row in rows:
+                    self._merge_record(row, sess)
+            else:
+                sess.execute(sqlalchemy.insert(self.Record.__table__), rows)
+            if self.journal:
+                sess.execute(sqlalchemy.insert(self.JournalEntry.__table__),
+                             rows)
+            sess.commit()
+        if self.progress_counters:
+            self.rebuild_progress(sess)
+        if self.normalize_values:
+            self.rebuild_values(sess)
+
+
+def _create_indexes(conn, table, names):
+    for index in Base.metadata.tables[table].indexes:
+        if index.name in names:
+            index.create(bind=conn, checkfirst=True)
+
+
+def _migrate_last_update_index(conn):
+    '''
+    Index records by last_update for the incremental exports.
+    '''
+    _create_indexes(conn, 'records', ['ix_records_last_update'])
+
+
+def _migrate_records_indexes(conn):
+    '''
+    Index records by (username, completed, ai) and (case_id, ai).
+    '''
+    _create_indexes(conn, 'records',
+                    ['ix_records_username_completed', 'ix_records_case_id'])
+
+
+def _migrate_diagnosis_values(conn):
+    '''
+    Drop the diagnosis from record_values, which only holds item values.
+    '''
+    table = Base.metadata.tables['record_values']
+    conn.execute(table.delete().where(table.c.item_id == DIAGNOSIS_KEY))
+
+
+# Forward migrations of existing databases. Version n is MIGRATIONS[n - 1].
+# New tables are created by create_all, so only changes to existing tables
+# need a migration. Append, never reorder.
+MIGRATIONS = [
+    _migrate_last_update_index,
+    _migrate_records_indexes,
+    _migrate_diagnosis_values,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='recorder migrate',
+        description='Apply the pending schema migrations.')
+    parser.add_argument('input',
+                        help='Input sqlite3 filename',
+                        metavar='<input>')
+    args = parser.parse_args(argv)
+
+    db = RecordDB('sqlite:///' + args.input.replace('\\', '/'), migrate=False)
+    for version in db.migrate():
+        print('applied', version, MIGRATIONS[version - 1].__doc__.strip())
+    print('schema version', db.schema_version())
+    return 0
+
+
+def add_items_argument(parser):
+    parser.add_argument('--items',
+                        help='Items csv to decode records stored with the '
+                        'compact codec',
+                        metavar='<items>')
+
+
+def load_codec(items):
+    if items is None:
+        return None
+    from .codec import CompactCodec
+    from .experiment import load_items
+    return CompactCodec(load_items(items)[0])
+
+
+def codec_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='recorder codec',
+        description='Re-encode the data of existing records.')
+    parser.add_argument('codec',
+                        choices=['compact', 'json'],
+                        help='compact: positional binary encoding by the '
+                        'order of the items. json: JSON text')
+    parser.add_argument('input',
+                        help='Input sqlite3 filename',
+                        metavar='<input>')
+    parser.add_argument('items', help='Items csv', metavar='<items>')
+    args = parser.parse_args(argv)
+
+    db = RecordDB('sqlite:///' + args.input.replace('\\', '/'),
+                  codec=load_codec(args.items))
+    encode = encode_json if args.codec == 'json' else None
+    with db.new_session() as sess:
+        print(db.recode_records(encode, sess), 'rows re-encoded')
+    return 0
+
+
+def analytics_main(argv):
+    import argparse
+    from .analytics import Agreement
+    from .experiment import load_reference
+    parser = argparse.ArgumentParser(
+        prog='recorder analytics',
+        description='Agreement between readers and the reference values.')
+    parser.add_argument('input',
+                        help='Input sqlite3 filename',
+                        metavar='<input>')
+    parser.add_argument('reference',
+                        help='Reference csv filename',
+                        metavar='<reference>')
+    add_items_argument(parser)
+    args = parser.parse_args(argv)
+
+    ref_dict = load_reference(args.reference)
+    case_ids = list(ref_dict)
+    item_ids = list(ref_dict[case_ids[0]]) if case_ids else []
+    db = RecordDB('sqlite:///' + args.input.replace('\\', '/'),
+                  codec=load_codec(args.items))
+    with db.new_session() as sess:
+        usernames = [
+            username for username, in sess.query(RecordDB.Record.username).
+            distinct().order_by(RecordDB.Record.username)
+        ]
+        agreement = Agreement(usernames, case_ids, item_ids, ref_dict)
+        print(json.dumps(agreement.summary(db, sess), indent=1))
+    return 0
+
+
+def journal_main(argv):
     import argparse
+    parser = argparse.ArgumentParser(
+        prog='recorder journal',
+        description='Rebuild records from the edit journal or compact it.')
+    parser.add_argument('command',
+                        choices=['rebuild', 'compact'],
+                        help='rebuild: replace the records with the latest '
+                        'journal entries. compact: delete superseded entries')
+    parser.add_argument('input',
+                        help='Input sqlite3 filename',
+                        metavar='<input>')
+    parser.add_argument(
+        '--before',
+        help='Compact only entries written before this ISO timestamp',
+        metavar='<timestamp>')
+    args = parser.parse_args(argv)
+
+    db = RecordDB('sqlite:///' + args.input.replace('\\', '/'), journal=True)
+    with db.new_session() as sess:
+        if args.command == 'rebuild':
+            print(db.replay_journal(sess), 'records rebuilt')
+        else:
+            before = None
+            if args.before:
+                before = datetime.datetime.fromisoformat(args.before)
+            print(db.compact_journal(before, sess), 'entries deleted')
+    return 0
+
+
+def main(argv=None):
+    import argparse
+    import sys
     from pathlib import Path
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['analytics']:
+        return analytics_main(argv[1:])
+    if argv[:1] == ['journal']:
+        return journal_main(argv[1:])
+    if argv[:1] == ['codec']:
+        return codec_main(argv[1:])
+    if argv[:1] == ['migrate']:
+        return migrate_main(argv[1:])
     parser = argparse.ArgumentParser(
-        description='Convert between sqlite3 database and csv file.')
+        description='Convert between sqlite3 database and csv file. '
+        'Run "%(prog)s analytics|journal|codec|migrate -h" '
+        'for the other commands.')
     parser.add_argument('input',
                         help='Input sqlite3/csv filename:',
                         metavar='<input>')
     parser.add_argument('output',
                         help='Output sqlite3/csv filename',
                         metavar='<output>')
+    parser.add_argument('--upsert',
+                        action='store_true',
+                        help='Import into an existing database, '
+                        'updating records that already exist')
+    parser.add_argument('--journal',
+                        action='store_true',
+                        help='Also append the imported records to the journal')
+    parser.add_argument('--chunk_size',
+                        type=int,
+                        default=IMPORT_CHUNK_SIZE,
+                        help='Rows per import chunk. default: %(default)s',
+                        metavar='<n>')
+    parser.add_argument(
+        '--since',
+        help='Export only records updated after this ISO timestamp',
+        metavar='<timestamp>')
+    add_items_argument(parser)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     in_filename = Path(args.input)
     out_filename = Path(args.output)
 
     if (in_filename.suffix == '.csv'
             and out_filename.suffix == '.sqlite3'):  # csv -> db
-        if (out_filename.exists()):
+        if (out_filename.exists() and not args.upsert):
             print(out_filename, ' already exists')
             return 1
-        db = RecordDB('sqlite:///' + args.output.replace('\\', '/'))
-        db.from_csv(args.input)
+        db = RecordDB('sqlite:///' + args.output.replace('\\', '/'),
+                      journal=args.journal)
+        db.from_csv(args.input, chunk_size=args.chunk_size, upsert=args.upsert)
 
     elif (in_filename.suffix == '.sqlite3'
           and out_filename.suffix == '.csv'):  # db -> csv
-        db = RecordDB('sqlite:///' + args.input.replace('\\', '/'))
-        db.to_csv(args.output)
+        db = RecordDB('sqlite:///' + args.input.replace('\\', '/'),
+                      codec=load_codec(args.items))
+        since = None
+        if args.since:
+            since = datetime.datetime.fromisoformat(args.since)
+        watermark = db.to_csv(args.output, since=since)
+        if watermark is not None:
+            print('watermark', watermark.isoformat())
     else:
         print('Invalid input output combination')
         return 1
@@ -0,0 +1,48 @@
+'''
+Per-login state (the seed of the case order) shared by the workers.
+'''
+import threading
+
+
+class MemoryStateStore():
+    '''
+    State local to the process. For a single worker process.
+    '''
+    def __init__(self):
+        self._seeds = {}
+        self._lock = threading.Lock()
+
+    def get_seed(self, username, default=0):
+        with self._lock:
+            return self._seeds.get(username, default)
+
+    def set_seed(self, username, seed):
+        with self._lock:
+            self._seeds[username] = seed
+
+
+class DBStateStore():
+    '''
+    State in the login_states table of the RecordDB, shared by all the
+    worker processes. Not cached, since a login may be served by another
+    process at any time.
+    '''
+    def __init__(self, db):
+        self.db = db
+
+    def get_seed(self, username, default=0):
+        with self.db.new_session() as sess:
+            seed = self.db.get_login_seed(username, sess)
+        return default if seed is None else seed
+
+    def set_seed(self, username, seed):
+        with self.db.new_session() as sess:
+            self.db.set_login_seed(username, seed, sess)
+
+
+def make_state_store(backend, db):
+    if backend == 'memory':
+        return MemoryStateStore()
+    elif backend == 'db':
+        return DBStateStore(db)
+    raise ValueError('Unknown state backend: {}'.format(backend))
@@ -0,0 +1,110 @@
+import atexit
+import os
+import signal
+import threading
+
+
+class WriteBehindBuffer():
+    '''
+    Coalesce draft saves by (username, case_id, ai) and write them to
+    the RecordDB in batches, every interval seconds or when max_size
+    drafts are pending. interval <= 0 writes drafts through immediately.
+    '''
+    def __init__(self, db, interval=1.0, max_size=100):
+        self.db = db
+        self.interval = interval
+        self.max_size = max_size
+        self._pending = {}
+        self._lock = threading.Lock()  # guards _pending
+        self._flush_lock = threading.Lock()  # serializes writes
+        self._stop = threading.Event()
+        self._thread = None
+        if interval > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    @property
+    def enabled(self):
+        return self._thread is not None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def put(self, username, case_id, data, elapsed_time, ai):
+        row = dict(username=username,
+                   case_id=case_id,
+                   data=data,
+                   elapsed_time=elapsed_time,
+                   ai=ai,
+                   completed=False)
+        if not self.enabled:
+            with self.db.new_session() as sess:
+                self.db.update_records([row], sess, keep_completed=True)
+            return
+        with self._lock:
+            self._pending[(username, case_id, ai)] = row
+            full = len(self._pending) >= self.max_size
+        if full:
+            self.flush()
+
+    def _take(self, match):
+        with self._lock:
+            keys = [key for key in self._pending if match(key)]
+            return [self._pending.pop(key) for key in keys]
+
+    def flush(self, username=None, keys=None):
+        '''
+        Write pending drafts. All of them by default,
+        or only those of username or with the given keys.
+        '''
+        if not self._pending:
+            return
+        if keys is not None:
+            keys = set(keys)
+            match = keys.__contains__
+        elif username is not None:
+            match = lambda key: key[0] == username
+        else:
+            match = lambda key: True
+        with self._flush_lock:
+            rows = self._take(match)
+            if rows:
+                with self.db.new_session() as sess:
+                    self.db.update_records(rows, sess, keep_completed=True)
+
+    def discard(self, keys):
+        '''
+        Drop pending drafts superseded by a synchronous write.
+        Waits for an in-flight flush so that it cannot overwrite the write.
+        '''
+        keys = set(keys)
+        with self._flush_lock:
+            self._take(keys.__contains__)
+
+    def drain_on_signals(self, signums=(signal.SIGTERM, signal.SIGINT)):
+        '''
+        Write the pending drafts when the process is stopped by one of the
+        signals, which atexit does not cover, then hand the signal on to
+        the previous handler. Only possible from the main thread.
+        '''
+        previous = {}
+
+        def handler(signum, frame):
+            self.close()
+            if callable(previous[signum]):
+                previous[signum](signum, frame)
+            elif previous[signum] != signal.SIG_IGN:
+                # terminate by the signal as without the handler
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        for signum in signums:
+            previous[signum] = signal.signal(signum, handler)
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        self.flush()
@@ -0,0 +1,343 @@
+'''
+Load test simulating a full reading session.
+
+Readers log in, open cases, autosave, fix without AI then with AI,
+while an admin polls /admin and downloads the csv. Reports throughput
+and p50/p95/p99 latency per route as JSON.
+
+By default the app is driven in-process through the Flask test client
+with generated inputs. Use --url to drive a running server instead
+(its INTERVAL should be 0 so that the with AI cases can be opened).
+'''
+import os
+import sys
+import csv
+import json
+import contextlib
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+import http.cookiejar
+
+
+class TestClientSession():
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, url, data=None, form=None):
+        rv = self.client.open(url, method=method, data=form or data)
+        rv.get_data()
+        return rv.status_code
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class UrlSession():
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            NoRedirect)
+
+    def request(self, method, url, data=None, form=None):
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode('utf8')
+        req = urllib.request.Request(self.base_url + url,
+                                     data=data,
+                                     method=method)
+        try:
+            with self.opener.open(req) as res:
+                res.read()
+                return res.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+class Recorder():
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, session, route, method, url, **kwargs):
+        start = time.perf_counter()
+        status = session.request(method, url, **kwargs)
+        elapsed = time.perf_counter() - start
+        key = '{} {}'.format(method, route)
+        with self._lock:
+            self.samples.setdefault(key, []).append(elapsed)
+            if status >= 400:
+                self.errors[key] = self.errors.get(key, 0) + 1
+        return status
+
+
+def percentile(sorted_values, q):
+    index = min(
+        len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(recorder, duration):
+    routes = {}
+    for key, samples in sorted(recorder.samples.items()):
+        samples = sorted(samples)
+        routes[key] = dict(count=len(samples),
+                           errors=recorder.errors.get(key, 0),
+                           throughput=len(samples) / duration,
+                           mean=sum(samples) / len(samples),
+                           p50=percentile(samples, 0.50),
+                           p95=percentile(samples, 0.95),
+                           p99=percentile(samples, 0.99))
+    n_requests = sum(len(samples) for samples in recorder.samples.values())
+    return dict(duration=duration,
+                requests=n_requests,
+                throughput=n_requests / duration,
+                errors=sum(recorder.errors.values()),
+                routes=routes)
+
+
+def load_dashboard(session, record):
+    # the dashboard page fetches its cases from the API
+    record(session, '/', 'GET', '/')
+    record(session, '/api/v1/cases', 'GET', '/api/v1/cases')
+
+
+def reader_session(session, record, username, password, case_ids, item_ids,
+                   n_autosaves, rng):
+    record(session,
+           '/login',
+           'POST',
+           '/login',
+           form=dict(username=username, password=password))
+    load_dashboard(session, record)
+    for w_wo in ['wo', 'w']:
+        for case_id in case_ids:
+            url = '/{}/case/{}'.format(w_wo, case_id)
+            record(session, '/<w_wo>/case/<case_id>', 'GET', url)
+            values = {}
+            for i in range(n_autosaves):
+                values[item_ids[i % len(item_ids)]] = str(rng.randint(0, 100))
+                values['elapsed_time'] = i
+                record(session,
+                       '/<w_wo>/case/<case_id>',
+                       'PUT',
+                       url,
+                       data=json.dumps(values).encode('utf8'))
+            values.update(
+                {item_id: str(rng.randint(0, 100))
+                 for item_id in item_ids})
+            values['diagnosis'] = 0
+            record(session,
+                   '/<w_wo>/case/<case_id>/fix',
+                   'PUT',
+                   url + '/fix',
+                   data=json.dumps(values).encode('utf8'))
+            load_dashboard(session, record)
+    record(session, '/logout', 'GET', '/logout')
+
+
+def admin_session(session, record, password, done, poll_interval,
+                  download_every):
+    record(session,
+           '/login',
+           'POST',
+           '/login',
+           form=dict(username='admin', password=password))
+    i = 0
+    while not done.is_set():
+        record(session, '/admin', 'GET', '/admin')
+        if i % download_every == 0:
+            record(session, '/admin/download/csv', 'GET',
+                   '/admin/download/csv')
+        i += 1
+        done.wait(poll_interval)
+
+
+def generate_inputs(dirname, n_readers, n_cases, n_items):
+    config = {}
+    filename = os.path.join(dirname, 'users.csv')
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['username', 'password'])
+        writer.writerow(['admin', 'admin'])
+        for i in range(n_readers):
+            writer.writerow(['reader{:04d}'.format(i)] * 2)
+    config['USERS_CSV'] = filename
+
+    case_ids = ['Case{:05d}'.format(i) for i in range(n_cases)]
+    item_ids = ['item{:03d}'.format(i) for i in range(n_items)]
+    filename = os.path.join(dirname, 'case_ids.txt')
+    with open(filename, 'w') as f:
+        f.write('\n'.join(case_ids) + '\n')
+    config['CASE_IDS_TXT'] = filename
+
+    filename = os.path.join(dirname, 'items.csv')
+    with open(filename, 'w', newline='', encoding='cp932') as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ['id', 'name', 'left', 'right', 'group', 'allow_center'])
+        for i, item_id in enumerate(item_ids):
+            writer.writerow(
+                [item_id, item_id, 'L', 'R', 'g{}'.format(i // 5), 'TRUE'])
+    config['ITEMS_CSV'] = filename
+
+    filename = os.path.join(dirname, 'diagnosis.csv')
+    with open(filename, 'w', newline='', encoding='cp932') as f:
+        writer = csv.writer(f)
+        writer.writerow(['item', 'description'])
+        for c in 'ABCD':
+            writer.writerow([c, 'Description for ' + c])
+    config['DIAGNOSIS_CSV'] = filename
+
+    filename = os.path.join(dirname, 'reference.csv')
+    rng = random.Random(0)
+    with open(filename, 'w', newline='', encoding='cp932') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id'] + item_ids)
+        for case_id in case_ids:
+            writer.writerow([case_id] +
+                            [rng.randint(0, 100) for _ in item_ids])
+    config['REF_DATA_CSV'] = filename
+    return config
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--readers',
+                        type=int,
+                        default=20,
+                        help='Concurrent readers. default: %(default)s')
+    parser.add_argument('--cases',
+                        type=int,
+                        default=5,
+                        help='Cases read by each reader. default: %(default)s')
+    parser.add_argument('--autosaves',
+                        type=int,
+                        default=5,
+                        help='Autosaves per case. default: %(default)s')
+    parser.add_argument('--items',
+                        type=int,
+                        default=10,
+                        help='Items of generated inputs. default: %(default)s')
+    parser.add_argument('--poll_interval',
+                        type=float,
+                        default=0.5,
+                        help='Admin polling interval. default: %(default)s')
+    parser.add_argument('--download_every',
+                        type=int,
+                        default=10,
+                        help='Admin downloads csv every n polls. '
+                        'default: %(default)s')
+    parser.add_argument('--url',
+                        help='Drive a running server instead of the test '
+                        'client. Readers are taken from --users')
+    parser.add_argument('--users', help='Users csv for --url')
+    parser.add_argument('--case_ids', help='Case ids txt for --url')
+    parser.add_argument('--item_ids', help='Items csv for --url')
+    parser.add_argument('--config',
+                        action='append',
+                        default=[],
+                        metavar='KEY=VALUE',
+                        help='App config for the test client. e.g. '
+                        'STORAGE_PROFILE=concurrent')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Output json. default: stdout')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dirname:
+        if args.url:
+            with open(args.users) as f:
+                users = [(row['username'], row['password'])
+                         for row in csv.DictReader(f)]
+            with open(args.case_ids) as f:
+                all_case_ids = f.read().splitlines()
+            with open(args.item_ids, encoding='cp932') as f:
+                item_ids = [row['id'] for row in csv.DictReader(f)]
+            admin_password = dict(users)['admin']
+            readers = [u for u in users if u[0] != 'admin'][:args.readers]
+            new_session = lambda: UrlSession(args.url)
+        else:
+            sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+            import dokueiexp
+            config = generate_inputs(dirname, args.readers, max(args.cases, 1),
+                                     args.items)
+            config.update(INTERVAL='0',
+                          RECORD_DB='sqlite:///{}'.format(
+                              os.path.join(dirname, 'records.sqlite3')))
+            config.update(kv.split('=', 1) for kv in args.config)
+            with contextlib.redirect_stdout(sys.stderr):
+                app = dokueiexp.create_app(config)
+            with open(config['CASE_IDS_TXT']) as f:
+                all_case_ids = f.read().splitlines()
+            item_ids = ['item{:03d}'.format(i) for i in range(args.items)]
+            admin_password = 'admin'
+            readers = [('reader{:04d}'.format(i), ) * 2
+                       for i in range(args.readers)]
+            new_session = lambda: TestClientSession(app)
+
+        record = Recorder()
+        done = threading.Event()
+        rng = random.Random(args.seed)
+        threads = []
+        for username, password in readers:
+            case_ids = rng.sample(all_case_ids,
+                                  min(args.cases, len(all_case_ids)))
+            threads.append(
+                threading.Thread(target=reader_session,
+                                 args=(new_session(), record, username,
+                                       password, case_ids, item_ids,
+                                       args.autosaves,
+                                       random.Random(rng.random()))))
+        admin = threading.Thread(target=admin_session,
+                                 args=(new_session(), record, admin_password,
+                                       done, args.poll_interval,
+                                       args.download_every))
+
+        start = time.perf_counter()
+        admin.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        admin.join()
+        duration = time.perf_counter() - start
+
+    result = summarize(record, duration)
+    result['revision'] = git_revision()
+    result['params'] = {
+        k: v
+        for k, v in vars(args).items() if k not in ['output']
+    }
+    text = json.dumps(result, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 1 if result['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
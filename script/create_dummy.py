@@ -1,10 +1,14 @@
 import sys
+import os
 import argparse
+import datetime
 
 import pandas as pd
 import numpy as np
 
-parser = argparse.ArgumentParser(description='Create dummy reference data.')
+parser = argparse.ArgumentParser(
+    description='Create dummy reference data. '
+    'Optionally generate the other inputs and a records database too.')
 parser.add_argument('--items',
                     help='Input cscv with items. default: %(default)s',
                     metavar='<name>',
@@ -17,8 +21,83 @@ parser.add_argument('--reference',
                     help='Output reference csv. default: %(default)s',
                     metavar='<name>',
                     default='reference.csv')
+parser.add_argument('--n_users',
+                    type=int,
+                    help='Generate users csv (--users) with n readers',
+                    metavar='<n>')
+parser.add_argument('--users',
+                    help='Output users csv. default: %(default)s',
+                    metavar='<name>',
+                    default='users.csv')
+parser.add_argument('--n_cases',
+                    type=int,
+                    help='Generate case ids txt (--case_ids) with n cases',
+                    metavar='<n>')
+parser.add_argument('--n_items',
+                    type=int,
+                    help='Generate items csv (--items) with n items',
+                    metavar='<n>')
+parser.add_argument('--n_diagnosis',
+                    type=int,
+                    help='Generate diagnosis csv (--diagnosis) with n items',
+                    metavar='<n>')
+parser.add_argument('--diagnosis',
+                    help='Output diagnosis csv. default: %(default)s',
+                    metavar='<name>',
+                    default='diagnosis.csv')
+parser.add_argument('--records',
+                    help='Output sqlite3 database with generated records',
+                    metavar='<name>')
+parser.add_argument('--progress',
+                    type=float,
+                    default=0.5,
+                    help='Mean fraction of cases read by each reader. '
+                    'default: %(default)s',
+                    metavar='<ratio>')
+parser.add_argument('--seed',
+                    type=int,
+                    default=0,
+                    help='Random seed. default: %(default)s',
+                    metavar='<n>')
 
 args = parser.parse_args()
+rng = np.random.default_rng(args.seed)
+
+if args.n_users is not None:
+    usernames = ['reader{:05d}'.format(i) for i in range(args.n_users)]
+    pd.DataFrame({
+        'username': ['admin'] + usernames,
+        'password': ['admin'] + usernames
+    }).to_csv(args.users, index=False)
+
+if args.n_cases is not None:
+    with open(args.case_ids, 'w') as f:
+        f.write('\n'.join('Case{:06d}'.format(i)
+                          for i in range(args.n_cases)) + '\n')
+
+if args.n_items is not None:
+    item_ids = ['item{:03d}'.format(i + 1) for i in range(args.n_items)]
+    pd.DataFrame({
+        'id':
+        item_ids,
+        'name': ['Item{:03d}'.format(i + 1) for i in range(args.n_items)],
+        'left':
+        'L',
+        'right':
+        'R',
+        'group': ['g{}'.format(i // 5 + 1) for i in range(args.n_items)],
+        'allow_center':
+        rng.random(args.n_items) < 0.5
+    }).to_csv(args.items, index=False, encoding='cp932')
+
+if args.n_diagnosis is not None:
+    pd.DataFrame({
+        'item': ['D{}'.format(i + 1) for i in range(args.n_diagnosis)],
+        'description': [
+            'Full description for D{}'.format(i + 1)
+            for i in range(args.n_diagnosis)
+        ]
+    }).to_csv(args.diagnosis, index=False, encoding='cp932')
 
 df_items = pd.read_csv(args.items,
                        dtype=str,
@@ -29,7 +108,119 @@ df_items = pd.read_csv(args.items,
 with open(args.case_ids) as f:
     case_ids = f.read().splitlines()
 
-data = np.random.randint(0, 100, (len(case_ids), len(df_items)))
+data = rng.integers(0, 100, (len(case_ids), len(df_items)))
 df_ref = pd.DataFrame(data, columns=df_items['id'], index=case_ids)
 df_ref.index.name = 'id'
 df_ref.to_csv(args.reference, encoding='cp932')
+
+if args.records is None:
+    sys.exit(0)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from dokueiexp import recorder
+
+if os.path.exists(args.records):
+    print(args.records, 'already exists')
+    sys.exit(1)
+
+usernames = [
+    u for u in pd.read_csv(args.users, dtype=str)['username'] if u != 'admin'
+]
+n_users, n_cases, n_items = len(usernames), len(case_ids), len(df_items)
+n_diagnosis = len(pd.read_csv(args.diagnosis, encoding='cp932'))
+item_ids = df_items['id'].to_list()
+
+# the data of a record is joined from one token per item and the diagnosis,
+# looked up column-wise from the value
+item_tokens = [
+    np.array([
+        '{}"{}": "{}"'.format(', ' if i else '{', item_id, value)
+        for value in range(101)
+    ],
+             dtype=object) for i, item_id in enumerate(item_ids)
+]
+diagnosis_tokens = np.array(
+    [', "diagnosis": {}}}'.format(d) for d in range(n_diagnosis)],
+    dtype=object)
+usernames_array = np.array(usernames, dtype=object)
+case_ids_array = np.array(case_ids, dtype=object)
+now = np.datetime64(datetime.datetime.now(), 'us')
+# bounds the memory of the per chunk arrays of (users, cases, items)
+chunk_users = max(1, recorder.IMPORT_CHUNK_SIZE * 10 // (n_cases * n_items))
+
+
+def generate_records(users):
+    """
+    Rows (in INSERT_COLUMNS order) of the records of the readers in the
+    users slice, without AI then with AI.
+    """
+    n = users.stop - users.start
+    # each reader reads the cases in its own order up to its progress
+    rank = np.argsort(np.argsort(rng.random((n, n_cases)), axis=1), axis=1)
+    n_wo = np.clip(rng.normal(args.progress, 0.2, n), 0, 1) * n_cases
+    n_wo = n_wo.astype(int)[:, None]
+    n_w = (n_wo * rng.uniform(0.5, 1, (n, 1))).astype(int)
+    users_idx, cases_idx = np.nonzero(rank <= n_wo)
+    rank = rank[users_idx, cases_idx]
+    # readers deviate from the reference, less so with AI
+    wo_values = np.clip(
+        data[cases_idx] + rng.normal(0, 20, (len(cases_idx), n_items)), 0,
+        100).astype(int)
+    w_values = (wo_values + data[cases_idx]) // 2
+    wo_completed = rank < n_wo[users_idx, 0]
+    w_completed = rank < n_w[users_idx, 0]
+    rows = []
+    # readers read with AI only the cases they completed without AI
+    for ai, values, completed, read in [
+        (0, wo_values, wo_completed, np.ones_like(wo_completed)),
+        (1, w_values, w_completed, wo_completed),
+    ]:
+        n_read = int(read.sum())
+        values = values[read]
+        tokens = [
+            item_tokens[i][values[:, i]].tolist() for i in range(n_items)
+        ]
+        tokens.append(diagnosis_tokens[rng.integers(0, n_diagnosis,
+                                                    n_read)].tolist())
+        last_update = now - rng.integers(0, 7 * 24 * 3600,
+                                         n_read).astype('timedelta64[s]')
+        # the format of the sqlite DateTime of sqlalchemy
+        last_update = [
+            t.replace('T', ' ')
+            for t in np.datetime_as_string(last_update, unit='us').tolist()
+        ]
+        rows.extend(
+            zip(usernames_array[users.start + users_idx[read]].tolist(),
+                case_ids_array[cases_idx[read]].tolist(),
+                map(''.join, zip(*tokens)),
+                rng.integers(30, 600, n_read).tolist(), [ai] * n_read,
+                completed[read].astype(int).tolist(), last_update))
+    return rows
+
+
+INSERT_COLUMNS = [
+    'username', 'case_id', 'data', 'elapsed_time', 'ai', 'completed',
+    'last_update'
+]
+db = recorder.RecordDB('sqlite:///' + args.records.replace('\\', '/'))
+# plain DBAPI executemany of tuples, without the per row parameter
+# processing of sqlalchemy
+insert = 'INSERT INTO records ({}) VALUES ({})'.format(
+    ', '.join(INSERT_COLUMNS), ', '.join('?' * len(INSERT_COLUMNS)))
+n_records = 0
+with db.engine.begin() as conn:
+    # a throwaway database: do not wait for the disk
+    conn.exec_driver_sql('PRAGMA synchronous=OFF')
+    # building the secondary indexes once at the end is much cheaper than
+    # updating them per row
+    indexes = list(db.Record.__table__.indexes)
+    for index in indexes:
+        index.drop(conn)
+    for start in range(0, n_users, chunk_users):
+        rows = generate_records(slice(start, min(start + chunk_users,
+                                                 n_users)))
+        conn.exec_driver_sql(insert, rows)
+        n_records += len(rows)
+    for index in indexes:
+        index.create(conn)
+print(n_records, 'records created.')
@@ -6,5 +6,5 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     zip_safe=False,
-    install_requires=['flask', 'flask-login', 'pandas', 'SQLAlchemy'],
+    install_requires=['flask', 'flask-login', 'numpy', 'pandas', 'SQLAlchemy'],
 )
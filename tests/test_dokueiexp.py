@@ -1,34 +1,59 @@
 import os
+import re
+import random
+import gzip
+import shutil
+import signal
+import subprocess
+import sys
+import contextlib
 import tempfile
 import json
 import time
 
 import pytest
+import flask
 import pandas as pd
+import sqlalchemy
+from sqlalchemy.orm import Session
 import dokueiexp
+from dokueiexp import experiment, metrics, recorder
+from dokueiexp.fragments import CaseFragments
+from dokueiexp.order import CaseOrder
+from dokueiexp.cache import LRUCache
 
 ITEMS_CSV = 'tests/items.csv'
 INTERVAL_SEC = 2
 
 
-@pytest.fixture
-def client():
+def app_config(db_filename, **kwargs):
+    config = dict(USERS_CSV='tests/users.csv',
+                  CASE_IDS_TXT='tests/case_ids.txt',
+                  ITEMS_CSV=ITEMS_CSV,
+                  DIAGNOSIS_CSV='tests/diagnosis.csv',
+                  REF_DATA_CSV='tests/reference.csv',
+                  INTERVAL=str(INTERVAL_SEC / 60),
+                  RECORD_DB='sqlite:///{}'.format(db_filename))
+    config.update(kwargs)
+    return config
+
+
+@contextlib.contextmanager
+def app_client(**kwargs):
     with tempfile.NamedTemporaryFile() as temp:
         temp.close()
-        db_filename = temp.name
-        config = dict(USERS_CSV='tests/users.csv',
-                      CASE_IDS_TXT='tests/case_ids.txt',
-                      ITEMS_CSV=ITEMS_CSV,
-                      DIAGNOSIS_CSV='tests/diagnosis.csv',
-                      REF_DATA_CSV='tests/reference.csv',
-                      INTERVAL=str(INTERVAL_SEC / 60),
-                      RECORD_DB='sqlite:///{}'.format(db_filename))
-        app = dokueiexp.create_app(config)
+        app = dokueiexp.create_app(app_config(temp.name, **kwargs))
 
         with app.test_client() as client:
             yield client
 
 
+@pytest.fixture
+def client():
+    with app_client() as client:
+        yield client
+
+
 def login(client, username, password):
     return client.post('/login',
                        data=dict(username=username, password=password),
@@ -39,6 +64,17 @@ def logout(client):
     return client.get('/logout', follow_redirects=True)
 
 
+def dashboard(client, page=1):
+    '''
+    The dashboard page as rendered by the browser from the API.
+    '''
+    return client.get('/api/v1/cases?page={}'.format(page)).get_json()
+
+
+def case_state(cases, case_id):
+    return [case for case in cases['cases'] if case['case_id'] == case_id][0]
+
+
 def test_login_logout(client):
     """Make sure login and logout works."""
 
@@ -69,9 +105,10 @@ def test_user(client):
 
     # check progress
     rv = client.get('/', follow_redirects=True)
-    assert b'0/4' in rv.data
-    assert '未'.encode('utf8') in rv.data
-    assert '<td>完了</td>'.encode('utf8') not in rv.data
+    assert b'/api/v1/cases' in rv.data
+    cases = dashboard(client)
+    assert cases['progress']['wo']['completed'] == 0
+    assert {case['wo']['status'] for case in cases['cases']} == {'none'}
 
     # set one
     rv = client.put('/wo/case/Case001',
@@ -117,8 +154,9 @@ def test_user(client):
     assert b'success' in rv.data
 
     # test the interval
-    rv = client.get('/', follow_redirects=True)
-    assert '待'.encode('utf8') in rv.data
+    case = case_state(dashboard(client), 'Case001')
+    assert case['wo']['status'] == 'completed'
+    assert not case['w']['readable']
 
     rv = client.get('/w/case/Case001', follow_redirects=True)
     assert 'はまだ読影できません。'.encode('utf8') in rv.data
@@ -129,10 +167,11 @@ def test_user(client):
     assert '一時保存'.encode('utf8') in rv.data
 
     # test progress
-    rv = client.get('/', follow_redirects=True)
-    assert b'1/4, 0/4' in rv.data
-    assert '未'.encode('utf8') in rv.data
-    assert '<td>完了</td>'.encode('utf8') in rv.data
+    cases = dashboard(client)
+    assert cases['progress'] == dict(wo=dict(completed=1, total=4),
+                                     w=dict(completed=0, total=4))
+    assert case_state(cases, 'Case002')['wo']['status'] == 'none'
+    assert case_state(cases, 'Case001')['wo']['status'] == 'completed'
 
     rv = client.get('/wo/case/Case001', follow_redirects=True)
     assert 'すでに確定しています。'.encode('utf8') in rv.data
@@ -194,3 +233,679 @@ def test_admin(client):
     rv = client.get('/user/alice/wo/case/Case001', follow_redirects=True)
     assert b'Admin only' in rv.data
     assert 403 == rv.status_code
+
+
+def test_cache_generation():
+    cache = LRUCache()
+    generation = cache.generation('alice')
+    cache.update('alice', lambda value: value + 1)  # a write while reading
+    cache.set('alice', 0, generation)
+    assert cache.get('alice') is None
+    cache.set('alice', 0, cache.generation('alice'))
+    cache.update('alice', lambda value: value + 1)
+    assert cache.get('alice') == 1
+
+
+def test_dashboard_cache(client):
+    login(client, 'alice', 'alice')
+    assert dashboard(client)['progress']['wo']['completed'] == 0
+    rv = client.put('/wo/case/Case002/fix',
+                    data=json.dumps({
+                        'item01': '10'
+                    }).encode('utf8'),
+                    follow_redirects=True)
+    assert b'success' in rv.data
+    # the cached dashboard state is patched by the write
+    cases = dashboard(client)
+    assert cases['progress']['wo']['completed'] == 1
+    assert not case_state(cases, 'Case002')['w']['readable']
+
+
+def test_admin_events(client):
+    login(client, 'admin', 'admin')
+    rv = client.get('/admin/events', buffered=False)
+    assert rv.mimetype == 'text/event-stream'
+    stream = iter(rv.response)
+    assert next(stream).startswith(b'retry:')
+
+    reader = client.application.test_client()
+    login(reader, 'alice', 'alice')
+    rv_fix = reader.put('/wo/case/Case002/fix',
+                        data=json.dumps({
+                            'item01': '10'
+                        }).encode('utf8'))
+    assert 200 == rv_fix.status_code
+    event = json.loads(next(stream)[len(b'data: '):])
+    assert event == dict(username='alice',
+                         case_id='Case002',
+                         ai=False,
+                         completed=True,
+                         progress=1)
+    # the draft with AI seeded by the fix
+    event = json.loads(next(stream)[len(b'data: '):])
+    assert (event['ai'], event['completed'], event['progress']) == (True,
+                                                                    False, 1)
+    # the count is queried from the records of the user
+    reader.put('/wo/case/Case003/fix',
+               data=json.dumps({
+                   'item01': '10'
+               }).encode('utf8'))
+    event = json.loads(next(stream)[len(b'data: '):])
+    assert (event['case_id'], event['progress']) == ('Case003', 2)
+    rv.close()
+
+
+def test_admin_bulk(client):
+    login(client, 'alice', 'alice')
+    for case_id in ['Case001', 'Case002']:
+        client.put('/wo/case/{}/fix'.format(case_id),
+                   data=json.dumps({
+                       'item01': '10'
+                   }).encode('utf8'))
+    assert dashboard(client)['progress'] == dict(wo=dict(completed=2, total=4),
+                                                 w=dict(completed=0, total=4))
+    logout(client)
+
+    login(client, 'admin', 'admin')
+    rv = client.put('/user/bob/wo/case/Case001/unfix')
+    assert 404 == rv.status_code
+    rv = client.put('/user/alice/wo/case/Case001/unfix')
+    assert 200 == rv.status_code
+    rv = client.post('/admin/bulk', json=dict(operation='drop'))
+    assert 400 == rv.status_code
+    rv = client.post('/admin/bulk',
+                     json=dict(operation='reassign', users=['alice'],
+                               to='eve'))
+    assert 400 == rv.status_code
+    rv = client.post('/admin/bulk',
+                     json=dict(operation='unfix', users=['alice'], ai=False))
+    assert rv.get_json() == dict(result='success', count=1)
+    rv = client.post('/admin/bulk',
+                     json=dict(operation='reset', users=['alice'], ai=True))
+    assert rv.get_json() == dict(result='success', count=2)
+    rv = client.post('/admin/bulk',
+                     json=dict(operation='reassign', users=['alice'],
+                               to='bob'))
+    assert rv.get_json() == dict(result='success', count=2)
+    logout(client)
+
+    login(client, 'bob', 'bob')
+    cases = dashboard(client)
+    assert cases['progress']['wo']['completed'] == 0
+    assert cases['progress']['w']['completed'] == 0
+    assert {case['wo']['status']
+            for case in cases['cases']} == {'none', 'draft'}
+
+
+def test_compact_codec():
+    with app_client(RECORD_CODEC='compact') as client:
+        login(client, 'alice', 'alice')
+        client.put('/wo/case/Case001',
+                   data=json.dumps({
+                       'item02': '30',
+                       'diagnosis': 1,
+                       'elapsed_time': 3
+                   }).encode('utf8'))
+        rv = client.get('/wo/case/Case001')
+        assert b'value=30 ' in rv.data
+        assert b'<option value="1" selected' in rv.data
+        logout(client)
+
+        login(client, 'admin', 'admin')
+        rv = client.get('/admin/download/jsonl')
+        row = json.loads(rv.data.decode('utf8'))
+        assert row['data'] == {'item02': '30', 'diagnosis': 1}
+
+
+def test_case_order():
+    case_ids = ['Case{:03d}'.format(i) for i in range(10)]
+    order = CaseOrder(case_ids, 42)
+    shuffled = random.Random(42).sample(case_ids, len(case_ids))
+    assert order.page(1, 0) == shuffled
+    assert order.page(2, 4) == shuffled[4:8]
+    assert order.page(3, 4) == shuffled[8:]
+    assert order.n_pages(4) == 3
+    assert CaseOrder(case_ids).page(1, 3) == case_ids[:3]
+
+    done = set(shuffled[:3])
+    assert order.next_unread(False, done) == shuffled[3]
+    done.add(shuffled[3])
+    assert order.next_unread(False, done) == shuffled[4]
+    # unfixed behind the cursor, e.g. by another process
+    done.discard(shuffled[1])
+    assert order.next_unread(False, done) == shuffled[1]
+    assert order.next_unread(True, {shuffled[0]}) == shuffled[1]
+    assert order.next_unread(True, {shuffled[0], 'Case999'}) == shuffled[1]
+    assert order.first([shuffled[5], 'Case999', shuffled[2]]) == shuffled[2]
+    assert order.first(['Case999']) is None
+
+
+def test_paginated_dashboard():
+    with app_client(DASHBOARD_PAGE_SIZE='3') as client:
+        login(client, 'alice', 'alice')
+        cases = dashboard(client)
+        assert (cases['page'], cases['n_pages']) == (1, 2)
+        assert len(cases['cases']) == 3
+        cases = dashboard(client, 2)
+        assert (cases['page'], cases['n_pages']) == (2, 2)
+        assert len(cases['cases']) == 1
+
+        rv = client.get('/next')
+        first = rv.headers['Location']
+        assert re.search(r'/wo/case/Case\d+$', first)
+        rv = client.put(first + '/fix',
+                        data=json.dumps({
+                            'item01': '10'
+                        }).encode('utf8'))
+        assert 200 == rv.status_code
+        # the with AI reading has to wait for the interval
+        rv = client.get('/next')
+        assert rv.headers['Location'] not in [first, first.replace('wo', 'w')]
+        time.sleep(INTERVAL_SEC)
+        rv = client.get('/next')
+        assert rv.headers['Location'] == first.replace('/wo/', '/w/')
+
+
+def test_next_readable(client):
+    login(client, 'alice', 'alice')
+    order = [case['case_id'] for case in dashboard(client)['cases']]
+    for case_id in order[1:]:
+        client.put('/wo/case/{}/fix'.format(case_id), data=b'{"item01": "10"}')
+    time.sleep(INTERVAL_SEC)
+    client.put('/wo/case/{}/fix'.format(order[0]), data=b'{"item01": "10"}')
+    # the first case waits for the interval, a later one is readable
+    rv = client.get('/next')
+    assert rv.headers['Location'] == '/w/case/{}'.format(order[1])
+
+
+def test_api(client):
+    rv = client.get('/api/v1/cases')
+    assert 401 == rv.status_code
+    login(client, 'alice', 'alice')
+    rv = client.get('/api/v1/cases')
+    cases = rv.get_json()
+    assert cases['version'] == 1
+    assert cases['progress']['wo'] == dict(completed=0, total=4)
+    assert sorted(case['case_id'] for case in cases['cases']) == [
+        'Case001', 'Case002', 'Case003', 'Case004'
+    ]
+    assert all(case['wo']['status'] == 'none' for case in cases['cases'])
+    assert client.get('/api/cases').get_json() == cases
+    rv = client.get('/api/v1/cases',
+                    headers={'If-None-Match': rv.headers['ETag']})
+    assert 304 == rv.status_code
+
+    client.put('/wo/case/Case002/fix',
+               data=json.dumps({
+                   'item01': '10',
+                   'diagnosis': 0,
+                   'elapsed_time': 5
+               }).encode('utf8'))
+    rv = client.get('/api/v1/case/wo/Case002')
+    assert rv.get_json() == dict(version=1,
+                                 case_id='Case002',
+                                 ai=False,
+                                 completed=True,
+                                 elapsed_time=5,
+                                 data={
+                                     'item01': '10',
+                                     'diagnosis': 0
+                                 },
+                                 ref_data={})
+    assert 403 == client.get('/api/v1/case/w/Case002').status_code
+    assert 404 == client.get('/api/v1/case/wo/Case999').status_code
+    cases = client.get('/api/v1/cases').get_json()
+    case = [case for case in cases['cases'] if case['case_id'] == 'Case002'][0]
+    assert case['wo']['status'] == 'completed'
+    assert case['w'] == dict(status='none',
+                             last_update=None,
+                             elapsed_time=0,
+                             readable=False)
+
+    time.sleep(INTERVAL_SEC)
+    rv = client.get('/api/v1/case/w/Case002')
+    case = rv.get_json()
+    assert not case['completed']
+    assert case['ref_data']['item01']
+    cases = client.get('/api/v1/cases').get_json()
+    assert [
+        case['w']['readable'] for case in cases['cases']
+        if case['case_id'] == 'Case002'
+    ] == [True]
+
+
+def test_download(client):
+    login(client, 'alice', 'alice')
+    client.put('/wo/case/Case001/fix',
+               data=json.dumps({
+                   'item01': '10'
+               }).encode('utf8'))
+    logout(client)
+
+    login(client, 'admin', 'admin')
+    rv = client.get('/admin/download/csv')
+    assert 200 == rv.status_code
+    assert 'attachment' in rv.headers['Content-Disposition']
+    lines = rv.data.decode('cp932').splitlines()
+    assert lines[0] == ('username,case_id,ai,last_update,elapsed_time,'
+                        'data,completed')
+    assert len(lines) == 3
+
+    rv = client.get('/admin/download/jsonl')
+    assert 200 == rv.status_code
+    rows = [json.loads(line) for line in rv.data.decode('utf8').splitlines()]
+    assert {(r['username'], r['ai'], r['completed'])
+            for r in rows} == {('alice', False, True), ('alice', True, False)}
+    assert rows[0]['data'] == {'item01': '10'}
+
+
+def test_download_since():
+    with app_client(EXPORT_OVERLAP='0') as client:
+        check_download_since(client)
+
+
+def test_download_overlap(client):
+    login(client, 'alice', 'alice')
+    client.put('/wo/case/Case001', data=b'{"item01": "10"}')
+    logout(client)
+
+    login(client, 'admin', 'admin')
+    rv = client.get('/admin/download/csv')
+    watermark = rv.headers['X-Watermark']
+    # records within the overlap window are exported again
+    rv = client.get('/admin/download/csv?since=' + watermark)
+    assert rv.headers['X-Watermark'] == watermark
+    assert len(rv.data.decode('cp932').splitlines()) == 2
+
+
+def check_download_since(client):
+    login(client, 'alice', 'alice')
+    client.put('/wo/case/Case001', data=b'{"item01": "10"}')
+    logout(client)
+
+    login(client, 'admin', 'admin')
+    rv = client.get('/admin/download/csv')
+    watermark = rv.headers['X-Watermark']
+    assert len(rv.data.decode('cp932').splitlines()) == 2
+
+    rv = client.get('/admin/download/csv?since=' + watermark)
+    assert rv.headers['X-Watermark'] == watermark
+    assert len(rv.data.decode('cp932').splitlines()) == 1
+    logout(client)
+
+    login(client, 'alice', 'alice')
+    client.put('/wo/case/Case002', data=b'{"item01": "20"}')
+    logout(client)
+
+    login(client, 'admin', 'admin')
+    rv = client.get('/admin/download/jsonl?since=' + watermark)
+    assert rv.headers['X-Watermark'] > watermark
+    rows = [json.loads(line) for line in rv.data.decode('utf8').splitlines()]
+    assert [r['case_id'] for r in rows] == ['Case002']
+
+    rv = client.get('/admin/download/csv?since=yesterday')
+    assert 400 == rv.status_code
+
+
+def test_write_behind():
+    with app_client(WRITE_BEHIND_INTERVAL='60') as client:
+        login(client, 'alice', 'alice')
+        client.put('/wo/case/Case001', data=b'{"item01": "10"}')
+        client.put('/wo/case/Case001', data=b'{"item01": "42"}')
+        # drafts are flushed before they are read
+        rv = client.get('/wo/case/Case001')
+        assert b'42' in rv.data
+        cases = dashboard(client)
+        assert case_state(cases, 'Case001')['wo']['status'] == 'draft'
+
+        client.put('/wo/case/Case002', data=b'{"item01": "10"}')
+        client.put('/wo/case/Case002/fix', data=b'{"item01": "20"}')
+        assert dashboard(client)['progress']['wo']['completed'] == 1
+
+
+DRAIN_SCRIPT = '''
+import sys
+sys.path.insert(0, 'tests')
+import dokueiexp
+from test_dokueiexp import app_config, login
+client = dokueiexp.create_app(
+    app_config(sys.argv[1], WRITE_BEHIND_INTERVAL='60')).test_client()
+login(client, 'alice', 'alice')
+client.put('/wo/case/Case001', data=b'{"item01": "42"}')
+print('ready', flush=True)
+sys.stdin.read()
+'''
+
+
+def test_write_behind_sigterm(tmp_path):
+    # the service is stopped by SIGTERM, which atexit does not cover
+    filename = tmp_path / 'records.sqlite3'
+    proc = subprocess.Popen(
+        [sys.executable, '-c', DRAIN_SCRIPT,
+         str(filename)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE)
+    try:
+        while proc.stdout.readline().strip() != b'ready':
+            assert proc.poll() is None
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(30) == -signal.SIGTERM
+    finally:
+        proc.kill()
+    db = recorder.RecordDB('sqlite:///{}'.format(filename))
+    with db.new_session() as sess:
+        record = db.get_record('alice', 'Case001', False, sess)
+        assert record.data == b'{"item01": "42"}'
+
+
+def test_analytics(client):
+    login(client, 'alice', 'alice')
+    client.put('/wo/case/Case001/fix', data=b'{"item01": "50"}')
+    logout(client)
+
+    login(client, 'admin', 'admin')
+    rv = client.get('/admin/analytics')
+    assert 200 == rv.status_code
+    summary = rv.get_json()
+    item01 = summary['items'].index('item01')
+    assert summary['per_item']['deviation_wo_ai'][item01] == 50
+    assert summary['per_item']['deviation_w_ai'][item01] is None
+    logout(client)
+
+    # refreshed incrementally
+    login(client, 'alice', 'alice')
+    client.put('/w/case/Case001/fix', data=b'{"item01": "10"}')
+    logout(client)
+
+    login(client, 'admin', 'admin')
+    summary = client.get('/admin/analytics').get_json()
+    assert summary['per_item']['deviation_w_ai'][item01] == 10
+    assert summary['per_item']['shift'][item01] == -40
+    assert summary['per_item']['gain'][item01] == 40
+    alice = summary['users'].index('alice')
+    assert summary['per_user']['n_values'][alice] == [1, 1]
+
+
+def test_experiment_snapshot(tmp_path):
+    config = dict(USERS_CSV='tests/users.csv',
+                  CASE_IDS_TXT='tests/case_ids.txt',
+                  ITEMS_CSV=ITEMS_CSV,
+                  DIAGNOSIS_CSV='tests/diagnosis.csv',
+                  REF_DATA_CSV='tests/reference.csv')
+    compiled = experiment.load_experiment(config, str(tmp_path))
+    assert compiled == experiment.compile_experiment(config)
+    assert compiled.case_ids == ['Case001', 'Case002', 'Case003', 'Case004']
+    assert compiled.ref_dict['Case001']['item02'] == '?'
+    assert not compiled.slider_groups['g2'][1].allow_center
+    snapshots = list(tmp_path.iterdir())
+    assert len(snapshots) == 1
+
+    # loaded from the snapshot
+    mtime = snapshots[0].stat().st_mtime_ns
+    assert experiment.load_experiment(config, str(tmp_path)) == compiled
+    assert snapshots[0].stat().st_mtime_ns == mtime
+
+    users_csv = tmp_path / 'users.csv'
+    users_csv.write_text('username,password\nadmin,admin\ncarol,1234\n')
+    config['USERS_CSV'] = str(users_csv)
+    recompiled = experiment.load_experiment(config, str(tmp_path))
+    assert recompiled.users['carol']['password'] == '1234'
+
+
+def test_experiment_reloader(tmp_path):
+    config = {}
+    for key, filename in [('USERS_CSV', 'users.csv'),
+                          ('CASE_IDS_TXT', 'case_ids.txt'),
+                          ('ITEMS_CSV', 'items.csv'),
+                          ('DIAGNOSIS_CSV', 'diagnosis.csv'),
+                          ('REF_DATA_CSV', 'reference.csv')]:
+        shutil.copy(os.path.join('tests', filename), tmp_path)
+        config[key] = str(tmp_path / filename)
+    reloader = experiment.ExperimentReloader(
+        config, experiment.compile_experiment(config))
+    assert not reloader.check()
+
+    with open(config['USERS_CSV'], 'a') as f:
+        f.write('carol,carol\n')
+    assert reloader.check()
+    assert 'carol' in reloader.current.users
+
+    # invalid until the reference is extended as well
+    with open(config['CASE_IDS_TXT'], 'a') as f:
+        f.write('Case005\n')
+    assert not reloader.check()
+    assert 'Case005' not in reloader.current.case_ids_set
+    with open(config['REF_DATA_CSV'], 'a') as f:
+        f.write('Case005,0,0,0,0\n')
+    assert reloader.check()
+    assert 'Case005' in reloader.current.case_ids_set
+    assert 'carol' in reloader.current.users
+
+
+def test_reload_during_request(tmp_path, monkeypatch):
+    config = app_config(tmp_path / 'records.sqlite3', STATE_BACKEND='db')
+    for key in experiment.SOURCES:
+        shutil.copy(config[key], tmp_path)
+        config[key] = str(tmp_path / os.path.basename(config[key]))
+    reloaders = []
+
+    class Reloader(experiment.ExperimentReloader):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            reloaders.append(self)
+
+    monkeypatch.setattr(experiment, 'ExperimentReloader', Reloader)
+    client = dokueiexp.create_app(config).test_client()
+    login(client, 'alice', 'alice')
+
+    get_login_seed = recorder.RecordDB.get_login_seed
+
+    def reload_while_reading(self, *args, **kwargs):
+        # the case list changes between the reads of the request
+        monkeypatch.setattr(recorder.RecordDB, 'get_login_seed',
+                            get_login_seed)
+        with open(config['CASE_IDS_TXT'], 'a') as f:
+            f.write('Case005\n')
+        with open(config['REF_DATA_CSV'], 'a') as f:
+            f.write('Case005,0,0,0,0\n')
+        assert reloaders[0].check()
+        return get_login_seed(self, *args, **kwargs)
+
+    monkeypatch.setattr(recorder.RecordDB, 'get_login_seed',
+                        reload_while_reading)
+    rv = client.get('/api/v1/cases')
+    assert len(rv.get_json()['cases']) == 4
+    # the order of the old cases is not kept for the new version
+    rv = client.get('/api/v1/cases',
+                    headers={'If-None-Match': rv.headers['ETag']})
+    assert 200 == rv.status_code
+    assert len(rv.get_json()['cases']) == 5
+
+
+def test_case_fragments():
+    sliders = {
+        'g<1>': [
+            experiment.Slider('item01', 'Item<01>', 'L', 'R', True),
+            experiment.Slider('item02', 'Item02', 'L', 'R', False)
+        ]
+    }
+    diagnosis = [
+        experiment.Diagnosis('A', 'a & b'),
+        experiment.Diagnosis('B', 'b')
+    ]
+    fragments = CaseFragments(sliders, diagnosis)
+    html = fragments.sliders({'item01': '42'}, {'item02': '<7>'})
+    assert html.count('<div class="sliders">') == 1
+    assert 'Item&lt;01&gt;' in html
+    assert 'id="item01" name="item01" min="0" max="100" value=42 onClick' in html
+    assert 'value=50 class="notset" data-nocenter onClick' in html
+    assert '&lt;7&gt;' in html
+    assert fragments.diagnosis_options({'diagnosis': 1}) == (
+        '<option value="0" >A</option><option value="1" selected>B</option>')
+    assert fragments.diagnosis_descriptions == '<li>a &amp; b</li><li>b</li>'
+
+
+def test_conditional_get(client):
+    login(client, 'alice', 'alice')
+    rv = client.get('/')
+    shell_etag = rv.headers['ETag']
+    rv = client.get('/', headers={'If-None-Match': shell_etag})
+    assert 304 == rv.status_code
+    assert b'' == rv.data
+    rv = client.get('/api/v1/cases')
+    etag = rv.headers['ETag']
+
+    rv = client.get('/wo/case/Case001')
+    case_etag = rv.headers['ETag']
+    assert 304 == client.get('/wo/case/Case001',
+                             headers={
+                                 'If-None-Match': case_etag
+                             }).status_code
+
+    client.put('/wo/case/Case001', data=b'{"item01": "42"}')
+    # the dashboard shell does not change with the records
+    rv = client.get('/', headers={'If-None-Match': shell_etag})
+    assert 304 == rv.status_code
+    rv = client.get('/api/v1/cases', headers={'If-None-Match': etag})
+    assert 200 == rv.status_code
+    assert rv.headers['ETag'] != etag
+    rv = client.get('/wo/case/Case001', headers={'If-None-Match': case_etag})
+    assert 200 == rv.status_code
+    assert b'42' in rv.data
+
+
+def test_conditional_get_deploy(client):
+    login(client, 'alice', 'alice')
+    shell_etag = client.get('/').headers['ETag']
+    case_etag = client.get('/wo/case/Case001').headers['ETag']
+    css = os.path.join(os.path.dirname(dokueiexp.__file__), 'static',
+                       'default.css')
+    stat = os.stat(css)
+    try:
+        # a deploy of a newer stylesheet
+        os.utime(css, (stat.st_atime, stat.st_mtime + 3600))
+        rv = client.get('/', headers={'If-None-Match': shell_etag})
+        assert 200 == rv.status_code
+        assert rv.headers['ETag'] != shell_etag
+        rv = client.get('/wo/case/Case001',
+                        headers={'If-None-Match': case_etag})
+        assert 200 == rv.status_code
+    finally:
+        os.utime(css, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def test_compression(client):
+    login(client, 'alice', 'alice')
+    rv = client.get('/wo/case/Case001', headers={'Accept-Encoding': 'gzip'})
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in rv.headers['Vary']
+    assert b'Item01' in gzip.decompress(rv.data)
+
+    rv = client.get('/wo/case/Case001')
+    assert 'Content-Encoding' not in rv.headers
+    assert b'Item01' in rv.data
+
+    rv = client.get('/static/default.css')
+    assert rv.cache_control.max_age == 365 * 24 * 3600
+
+
+def test_shared_state(tmp_path):
+    # two workers sharing the record DB
+    config = app_config(tmp_path / 'records.sqlite3', STATE_BACKEND='db')
+    client1 = dokueiexp.create_app(config).test_client()
+    client2 = dokueiexp.create_app(config).test_client()
+    for i in range(5):
+        login(client1, 'alice', 'alice')
+        client2.set_cookie('session', client1.get_cookie('session').value)
+        # the global random state does not affect the case order
+        random.seed(i)
+        order1 = [case['case_id'] for case in dashboard(client1)['cases']]
+        random.seed(i + 1)
+        order2 = [case['case_id'] for case in dashboard(client2)['cases']]
+        assert order1 == order2
+        assert len(order1) == 4
+        logout(client1)
+
+
+def test_shared_dashboard(tmp_path):
+    config = app_config(tmp_path / 'records.sqlite3', STATE_BACKEND='db')
+    client1 = dokueiexp.create_app(config).test_client()
+    client2 = dokueiexp.create_app(config).test_client()
+    login(client2, 'alice', 'alice')
+    rv = client2.get('/api/v1/cases')
+    assert rv.get_json()['progress']['wo']['completed'] == 0
+    etag = rv.headers['ETag']
+    login(client1, 'alice', 'alice')
+    rv = client1.put('/wo/case/Case002/fix',
+                     data=json.dumps({
+                         'item01': '10'
+                     }).encode('utf8'))
+    assert 200 == rv.status_code
+    # the other worker does not serve its own stale state
+    rv = client2.get('/api/v1/cases', headers={'If-None-Match': etag})
+    assert 200 == rv.status_code
+    assert rv.get_json()['progress']['wo']['completed'] == 1
+
+
+def test_shared_next(tmp_path):
+    config = app_config(tmp_path / 'records.sqlite3', STATE_BACKEND='db')
+    client1 = dokueiexp.create_app(config).test_client()
+    client2 = dokueiexp.create_app(config).test_client()
+    login(client1, 'alice', 'alice')
+    first = client1.get('/next').headers['Location']
+    client1.put(first + '/fix',
+                data=json.dumps({
+                    'item01': '10'
+                }).encode('utf8'))
+    assert client1.get('/next').headers['Location'] != first
+    # unfixed in the other worker
+    login(client2, 'admin', 'admin')
+    rv = client2.put('/user/alice' + first + '/unfix')
+    assert 200 == rv.status_code
+    assert client1.get('/next').headers['Location'] == first
+
+
+def test_metrics():
+    with app_client(METRICS='1') as client:
+        login(client, 'alice', 'alice')
+        client.get('/')
+        client.put('/wo/case/Case001/fix', data=b'{"item01": "42"}')
+        logout(client)
+        login(client, 'admin', 'admin')
+        rv = client.get('/admin/metrics')
+        assert 200 == rv.status_code
+        text = rv.data.decode('utf8')
+        labels = 'route="/<w_wo>/case/<case_id>/fix",method="PUT"'
+        assert ('dokueiexp_requests_total{{{},status="200"}} 1'.format(labels)
+                in text)
+        assert 'dokueiexp_request_duration_seconds_count{{{}}} 1'.format(
+            labels) in text
+        assert 'dokueiexp_db_commit_seconds_total{{{}}}'.format(labels) in text
+        queries = re.search(
+            r'dokueiexp_request_db_queries_sum{{{}}} (\d+)'.format(
+                re.escape(labels)), text)
+        assert int(queries.group(1)) > 0
+
+    with app_client() as client:
+        login(client, 'admin', 'admin')
+        assert 404 == client.get('/admin/metrics').status_code
+
+
+def test_metrics_failed_query():
+    app = flask.Flask(__name__)
+    engine = sqlalchemy.create_engine('sqlite://')
+    metrics.Metrics().init_app(app, engine)
+    with app.test_request_context():
+        app.preprocess_request()
+        with engine.connect() as conn:
+            with pytest.raises(sqlalchemy.exc.OperationalError):
+                conn.exec_driver_sql('SELECT * FROM missing')
+            conn.exec_driver_sql('SELECT 1')
+            assert not any(key.startswith('metrics') for key in conn.info)
+        assert 1 == flask.g.metrics['queries']
+    # the commit listeners are not added again per app
+    metrics.Metrics().init_app(flask.Flask(__name__), engine)
+    assert sqlalchemy.event.contains(Session, 'before_commit',
+                                     metrics._before_commit)
+    assert sqlalchemy.event.contains(Session, 'after_commit',
+                                     metrics._after_commit)
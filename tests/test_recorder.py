@@ -0,0 +1,520 @@
+import datetime
+import sqlite3
+import tempfile
+import threading
+import time
+
+import pytest
+import sqlalchemy
+from dokueiexp import recorder
+from dokueiexp.writebehind import WriteBehindBuffer
+from dokueiexp.codec import CompactCodec, HEADER
+
+
+@pytest.fixture(params=[False, True], ids=['aggregate', 'counters'])
+def db(request):
+    with tempfile.NamedTemporaryFile() as temp:
+        temp.close()
+        yield recorder.RecordDB('sqlite:///{}'.format(temp.name),
+                                progress_counters=request.param)
+
+
+def test_progress_summary(db):
+    with db.new_session() as sess:
+        db.update_record('alice', 'Case001', b'{}', 1, False, False, sess)
+        db.update_record('alice', 'Case001', b'{}', 2, False, True, sess)
+        db.update_record('alice', 'Case001', b'{}', 0, True, False, sess)
+        db.update_record('alice', 'Case002', b'{}', 1, False, False, sess)
+        db.update_record('bob', 'Case001', b'{}', 1, False, True, sess)
+        summary = db.progress_summary(sess)
+    assert summary['alice'].get((False, True)) == 1
+    assert summary['alice'].get((False, False)) == 1
+    assert summary['alice'].get((True, False)) == 1
+    assert summary['bob'].get((False, True)) == 1
+
+    with db.new_session() as sess:
+        db.update_record('alice', 'Case001', b'{}', 2, False, False, sess)
+        summary = db.progress_summary(sess)
+    assert summary['alice'].get((False, True), 0) == 0
+    assert summary['alice'].get((False, False)) == 2
+
+
+@pytest.mark.parametrize('native', [True, False], ids=['upsert', 'merge'])
+def test_fix_record(db, native, monkeypatch):
+    if not native:
+        monkeypatch.setattr(db,
+                            '_upsert_statement',
+                            lambda keep_completed=False: None)
+    commits = []
+    sqlalchemy.event.listen(db.engine, 'commit', commits.append)
+    with db.new_session() as sess:
+        db.update_record('alice', 'Case001', b'{"item01": "1"}', 3, False,
+                         False, sess)
+        db.fix_record('alice', 'Case001', b'{"item01": "2"}', 5, False, sess)
+        wo_rec = db.get_record('alice', 'Case001', False, sess)
+        w_rec = db.get_record('alice', 'Case001', True, sess)
+        assert wo_rec.completed and wo_rec.elapsed_time == 5
+        assert not w_rec.completed and w_rec.elapsed_time == 0
+        assert recorder.record_data2obj(w_rec.data) == {'item01': '2'}
+        summary = db.progress_summary(sess)
+    assert len(commits) == 2
+    assert summary['alice'] == {(False, True): 1, (True, False): 1}
+
+
+def test_last_update_index(db):
+    indexes = sqlalchemy.inspect(db.engine).get_indexes('records')
+    assert ['last_update'] in [index['column_names'] for index in indexes]
+
+
+def query_plan(db, query):
+    sql = str(
+        query.statement.compile(db.engine,
+                                compile_kwargs={'literal_binds': True}))
+    with db.engine.connect() as conn:
+        return ' '.join(row[-1]
+                        for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' +
+                                                        sql))
+
+
+def test_query_plans(db):
+    Record = db.Record
+    with db.new_session() as sess:
+        plan = query_plan(
+            db,
+            sess.query(Record).filter(Record.username == 'alice',
+                                      Record.completed.is_(True)))
+        assert 'ix_records_username_completed' in plan
+        plan = query_plan(
+            db,
+            sess.query(Record.case_id).filter(Record.case_id == 'Case001'))
+        assert 'ix_records_case_id' in plan
+        plan = query_plan(
+            db,
+            sess.query(Record).filter(
+                Record.last_update > datetime.datetime(2020, 1, 1)))
+        assert 'ix_records_last_update' in plan
+
+
+def test_migrate(tmp_path):
+    filename = tmp_path / 'records.sqlite3'
+    with sqlite3.connect(filename) as conn:  # before the migrations
+        conn.execute('CREATE TABLE records (username VARCHAR(64), '
+                     'case_id VARCHAR(64), data VARCHAR(1024), '
+                     'elapsed_time INTEGER, last_update DATETIME, '
+                     'ai BOOLEAN, completed BOOLEAN, '
+                     'PRIMARY KEY (username, case_id, ai))')
+    url = 'sqlite:///{}'.format(filename)
+    db = recorder.RecordDB(url, migrate=False)
+    assert db.schema_version() == 0
+    with pytest.raises(RuntimeError):
+        db.check_schema()
+    with db.new_session() as sess:
+        for item_id in ['item01', 'diagnosis']:
+            sess.add(
+                db.RecordValue(username='alice',
+                               case_id='Case001',
+                               ai=False,
+                               item_id=item_id,
+                               value=1))
+        sess.commit()
+    assert db.migrate() == list(range(1, recorder.SCHEMA_VERSION + 1))
+    with db.new_session() as sess:
+        assert [v.item_id for v in sess.query(db.RecordValue)] == ['item01']
+    assert db.migrate() == []
+    db.check_schema()
+    indexes = sqlalchemy.inspect(db.engine).get_indexes('records')
+    assert {
+        'ix_records_last_update', 'ix_records_username_completed',
+        'ix_records_case_id'
+    } <= {index['name']
+          for index in indexes}
+
+    # new databases start at the latest version
+    db = recorder.RecordDB('sqlite:///{}'.format(tmp_path / 'new.sqlite3'),
+                           migrate=False)
+    assert db.schema_version() == recorder.SCHEMA_VERSION
+
+
+def test_csv_roundtrip(db, tmp_path):
+    with db.new_session() as sess:
+        for i in range(5):
+            db.update_record('alice', 'Case{:03d}'.format(i),
+                             b'{"item01": "1"}', i, False, i % 2 == 0, sess)
+        db.to_csv(tmp_path / 'out.csv', sess)
+
+    restored = recorder.RecordDB('sqlite:///{}'.format(tmp_path /
+                                                       'restored.sqlite3'),
+                                 progress_counters=db.progress_counters)
+    with restored.new_session() as sess:
+        restored.from_csv(tmp_path / 'out.csv', sess, chunk_size=2)
+        # upsert over existing rows
+        restored.from_csv(tmp_path / 'out.csv',
+                          sess,
+                          chunk_size=2,
+                          upsert=True)
+        records = {r.case_id: r for r in restored.iter_records(sess)}
+        assert len(records) == 5
+        assert records['Case002'].completed
+        assert not records['Case003'].completed
+        assert records['Case004'].elapsed_time == 4
+        assert recorder.record_data2obj(records['Case000'].data) == {
+            'item01': '1'
+        }
+        assert restored.progress_summary(sess)['alice'] == {
+            (False, True): 3,
+            (False, False): 2
+        }
+
+
+def stress_writes(db, n_threads=8, n_writes=50):
+    '''
+    Concurrent autosaves from n_threads readers.
+    Returns (writes per second, number of failed writes)
+    '''
+    errors = []
+
+    def write(username):
+        with db.new_session() as sess:
+            for i in range(n_writes):
+                try:
+                    db.update_record(username, 'Case{:03d}'.format(i % 10),
+                                     b'{"item01": "1"}', i, False, False, sess)
+                except sqlalchemy.exc.OperationalError as e:
+                    errors.append(e)
+
+    threads = [
+        threading.Thread(target=write, args=('user{}'.format(i), ))
+        for i in range(n_threads)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return n_threads * n_writes / elapsed, len(errors)
+
+
+def test_concurrent_profile(tmp_path):
+    results = {}
+    for profile in ['default', 'concurrent']:
+        db = recorder.RecordDB('sqlite:///{}'.format(
+            tmp_path / '{}.sqlite3'.format(profile)),
+                               profile=profile)
+        results[profile] = stress_writes(db)
+        print(profile, '{:.0f} writes/s, {} failed'.format(*results[profile]))
+
+    db = recorder.RecordDB('sqlite:///{}'.format(tmp_path /
+                                                 'concurrent.sqlite3'),
+                           profile='concurrent')
+    with db.engine.connect() as conn:
+        assert conn.exec_driver_sql(
+            'PRAGMA journal_mode').scalar().lower() == 'wal'
+    with db.new_session() as sess:
+        assert sess.query(db.Record).count() == 8 * 10
+    assert results['concurrent'][1] == 0
+
+
+def test_concurrent_progress_counters(tmp_path):
+    db = recorder.RecordDB('sqlite:///{}'.format(tmp_path / 'records.sqlite3'),
+                           progress_counters=True,
+                           profile='concurrent')
+    errors = []
+
+    def write(thread):  # new drafts of the same user from each thread
+        with db.new_session() as sess:
+            for i in range(50):
+                try:
+                    db.update_record('alice', 'Case{}-{}'.format(thread, i),
+                                     b'{}', 1, False, i % 2 == 0, sess)
+                except sqlalchemy.exc.SQLAlchemyError as e:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(i, )) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    with db.new_session() as sess:
+        assert db.progress_summary(sess)['alice'] == {
+            (False, True): 200,
+            (False, False): 200
+        }
+
+
+def test_write_behind_buffer(db):
+    commits = []
+    sqlalchemy.event.listen(db.engine, 'commit', commits.append)
+    drafts = WriteBehindBuffer(db, interval=60, max_size=3)
+    for i in range(10):
+        drafts.put('alice', 'Case001', b'{}', i, False)
+    drafts.put('bob', 'Case001', b'{}', 1, False)
+    assert len(commits) == 0
+
+    drafts.flush(username='alice')
+    assert len(commits) == 1
+    with db.new_session() as sess:
+        assert db.get_record('alice', 'Case001', False, sess).elapsed_time == 9
+        assert db.get_record('bob', 'Case001', False, sess) is None
+
+    drafts.put('alice', 'Case002', b'{}', 1, False)
+    drafts.put('alice', 'Case003', b'{}', 1, False)  # reaches max_size
+    assert len(commits) == 2
+
+    drafts.put('alice', 'Case004', b'{}', 1, False)
+    drafts.close()
+    with db.new_session() as sess:
+        assert db.get_record('alice', 'Case004', False, sess)
+
+
+@pytest.mark.parametrize('native', [True, False], ids=['upsert', 'merge'])
+def test_write_behind_keeps_completed(db, native, monkeypatch):
+    if not native:
+        monkeypatch.setattr(db,
+                            '_upsert_statement',
+                            lambda keep_completed=False: None)
+    notified = []
+    db.add_listener(notified.extend)
+    # a draft pending in another worker's buffer while the case is fixed
+    drafts = WriteBehindBuffer(db, interval=60)
+    drafts.put('alice', 'Case001', b'{"item01": "1"}', 1, False)
+    drafts.put('alice', 'Case002', b'{"item01": "1"}', 1, False)
+    with db.new_session() as sess:
+        db.fix_record('alice', 'Case001', b'{"item01": "2"}', 2, False, sess)
+    notified.clear()
+    drafts.close()
+    with db.new_session() as sess:
+        record = db.get_record('alice', 'Case001', False, sess)
+        assert record.completed
+        assert record.data == b'{"item01": "2"}'
+        assert db.progress_summary(sess)['alice'][(False, True)] == 1
+    assert [state.case_id for state in notified] == ['Case002']
+
+
+def test_normalized_values(tmp_path):
+    db = recorder.RecordDB('sqlite:///{}'.format(tmp_path / 'db.sqlite3'),
+                           normalize_values=True)
+    with db.new_session() as sess:
+        db.fix_record('alice', 'Case001',
+                      b'{"item01": "10", "item02": "?", "diagnosis": 2}', 1,
+                      False, sess)
+        db.fix_record('bob', 'Case001', b'{"item01": "30"}', 1, False, sess)
+        db.update_record('bob', 'Case002', b'{"item01": "90"}', 1, False,
+                         False, sess)
+        db.update_record('alice', 'Case001', b'{"item01": "20"}', 1, True,
+                         False, sess)
+        assert sess.query(db.RecordValue).filter_by(ai=False).count() == 3
+
+        stats = db.item_stats(ai=False, sess=sess)
+        assert stats['item01'] == dict(count=2, mean=20, min=10, max=30)
+        assert 'diagnosis' not in stats
+        assert 'item02' not in stats
+        assert db.item_stats(ai=True, completed=False,
+                             sess=sess)['item01']['max'] == 30
+
+        db.rebuild_values(sess)
+        assert db.item_stats(ai=False, sess=sess)['item01']['count'] == 2
+
+
+def test_backfill_once(tmp_path, monkeypatch):
+    filename = 'sqlite:///{}'.format(tmp_path / 'records.sqlite3')
+    db = recorder.RecordDB(filename)
+    with db.new_session() as sess:
+        db.fix_record('bob', 'Case001', b'{"item01": "10"}', 1, False, sess)
+
+    rebuilt = []
+    rebuild = recorder.RecordDB._rebuild_values
+    monkeypatch.setattr(
+        recorder.RecordDB, '_rebuild_values',
+        lambda self, sess: rebuilt.append(1) or rebuild(self, sess))
+    db = recorder.RecordDB(filename, normalize_values=True)
+    db = recorder.RecordDB(filename, normalize_values=True)
+    assert rebuilt == [1]
+    with db.new_session() as sess:
+        assert db.item_stats(ai=False, sess=sess)['item01']['count'] == 1
+
+    # writes without normalize_values leave record_values behind
+    db = recorder.RecordDB(filename)
+    with db.new_session() as sess:
+        db.fix_record('bob', 'Case002', b'{"item01": "20"}', 1, False, sess)
+    db = recorder.RecordDB(filename, normalize_values=True)
+    assert rebuilt == [1, 1]
+    with db.new_session() as sess:
+        assert db.item_stats(ai=False, sess=sess)['item01']['count'] == 2
+
+
+def test_journal(tmp_path):
+    filename = 'sqlite:///{}'.format(tmp_path / 'records.sqlite3')
+    db = recorder.RecordDB(filename)
+    with db.new_session() as sess:
+        db.update_record('bob', 'Case001', b'{"item01": "1"}', 1, False, True,
+                         sess)
+
+    db = recorder.RecordDB(filename, progress_counters=True, journal=True)
+    with db.new_session() as sess:
+        # existing records are seeded into the journal
+        assert len(db.journal_history('bob', 'Case001', False, sess)) == 1
+        db.update_record('alice', 'Case001', b'{"item01": "1"}', 1, False,
+                         False, sess)
+        db.update_record('alice', 'Case001', b'{"item01": "2"}', 2, False,
+                         False, sess)
+        db.fix_record('alice', 'Case001', b'{"item01": "3"}', 3, False, sess)
+        history = db.journal_history('alice', 'Case001', False, sess)
+        assert [e.data for e in history] == [
+            b'{"item01": "1"}', b'{"item01": "2"}', b'{"item01": "3"}'
+        ]
+        assert [e.completed for e in history] == [False, False, True]
+
+        sess.query(db.Record).delete()
+        sess.commit()
+        assert db.replay_journal(sess) == 3
+        record = db.get_record('alice', 'Case001', False, sess)
+        assert record.data == b'{"item01": "3"}'
+        assert record.completed
+        assert db.get_record('alice', 'Case001', True, sess) is not None
+        assert db.progress_summary(sess)['alice'][(False, True)] == 1
+
+        assert db.compact_journal(sess=sess) == 2
+        assert len(db.journal_history('alice', 'Case001', False, sess)) == 1
+        assert db.replay_journal(sess) == 3
+        assert db.get_record('alice', 'Case001', False,
+                             sess).data == b'{"item01": "3"}'
+
+
+def test_journal_coverage(tmp_path):
+    filename = 'sqlite:///{}'.format(tmp_path / 'records.sqlite3')
+    db = recorder.RecordDB(filename, journal=True)
+    with db.new_session() as sess:
+        db.fix_record('bob', 'Case001', b'{"item01": "1"}', 1, False, sess)
+        db.to_csv(tmp_path / 'out.csv', sess)
+    # imports are journaled
+    imported = recorder.RecordDB('sqlite:///{}'.format(tmp_path /
+                                                       'imported.sqlite3'),
+                                 journal=True)
+    with imported.new_session() as sess:
+        imported.from_csv(tmp_path / 'out.csv', sess)
+        assert len(imported.journal_history('bob', 'Case001', False,
+                                            sess)) == 1
+
+    # writes made while the journal is disabled
+    time.sleep(0.01)
+    db = recorder.RecordDB(filename)
+    with db.new_session() as sess:
+        db.update_record('bob', 'Case001', b'{"item01": "2"}', 2, False, False,
+                         sess)
+        db.fix_record('alice', 'Case001', b'{"item01": "3"}', 3, False, sess)
+    db = recorder.RecordDB(filename, journal=True)
+    with db.new_session() as sess:
+        # are kept by the rebuild
+        assert db.replay_journal(sess) == 4
+        record = db.get_record('bob', 'Case001', False, sess)
+        assert record.data == b'{"item01": "2"}'
+        assert not record.completed
+        assert db.get_record('alice', 'Case001', False, sess).completed
+        assert len(db.journal_history('bob', 'Case001', False, sess)) == 2
+        assert db.replay_journal(sess) == 4
+        assert len(db.journal_history('bob', 'Case001', False, sess)) == 2
+
+
+def test_bulk_update(tmp_path):
+    db = recorder.RecordDB('sqlite:///{}'.format(tmp_path / 'records.sqlite3'),
+                           progress_counters=True,
+                           normalize_values=True,
+                           journal=True)
+    notified = []
+    db.add_listener(notified.extend)
+    with db.new_session() as sess:
+        for username in ['alice', 'bob']:
+            for case_id in ['Case001', 'Case002']:
+                db.fix_record(username, case_id, b'{"item01": "1"}', 1, False,
+                              sess)
+        notified.clear()
+
+        assert db.bulk_update('unfix', ['alice'], ai=False, sess=sess) == 2
+        assert db.bulk_update('unfix', ['alice'], ai=False, sess=sess) == 0
+        assert {(s.username, s.completed)
+                for s in notified} == {('alice', False)}
+        assert not db.get_record('alice', 'Case001', False, sess).completed
+        assert db.progress_summary(sess)['alice'] == {
+            (False, False): 2,
+            (True, False): 2
+        }
+        assert len(db.journal_history('alice', 'Case001', False, sess)) == 2
+
+        notified.clear()
+        assert db.bulk_update('reset', case_ids=['Case002'], sess=sess) == 4
+        assert all(s.completed is None for s in notified)
+        assert db.get_record('bob', 'Case002', False, sess) is None
+        assert db.item_stats(ai=False, sess=sess)['item01']['count'] == 1
+
+        assert db.bulk_update('reassign', ['bob'],
+                              new_username='carol',
+                              sess=sess) == 2
+        assert db.get_record('bob', 'Case001', False, sess) is None
+        assert db.get_record('carol', 'Case001', False, sess).completed
+        summary = db.progress_summary(sess)
+        assert 'bob' not in summary
+        assert summary['carol'] == {(False, True): 1, (True, False): 1}
+        with pytest.raises(sqlalchemy.exc.IntegrityError):
+            db.bulk_update('reassign', ['carol'],
+                           new_username='alice',
+                           sess=sess)
+        sess.rollback()
+        assert db.get_record('carol', 'Case001', False, sess) is not None
+
+        # the history of removed and moved records is kept
+        history = db.journal_history('bob', 'Case002', False, sess)
+        assert [e.completed for e in history] == [True, None]
+        history = db.journal_history('bob', 'Case001', False, sess)
+        assert [e.completed for e in history] == [True, None]
+        history = db.journal_history('carol', 'Case001', False, sess)
+        assert [(e.data, e.completed)
+                for e in history] == [(b'{"item01": "1"}', True)]
+        assert db.replay_journal(sess) == 4
+        assert db.get_record('bob', 'Case002', False, sess) is None
+        assert db.get_record('bob', 'Case001', False, sess) is None
+        assert db.get_record('carol', 'Case001', False, sess).completed
+
+
+def test_compact_codec(tmp_path):
+    codec = CompactCodec(['item01', 'item02', 'item03'])
+    obj = {'item03': '100', 'item01': '0', 'diagnosis': -1}
+    data = codec.encode(obj)
+    assert len(data) == HEADER.size + 3
+    assert codec.decode(data) == obj
+    assert codec.decode(codec.encode({})) == {}
+    for obj in [{
+            'item04': '1'
+    }, {
+            'item01': 1
+    }, {
+            'item01': '01'
+    }, {
+            'item01': '255'
+    }, {
+            'diagnosis': 'A'
+    }]:
+        assert codec.decode(codec.encode(obj)) == obj
+        assert codec.encode(obj)[:1] == b'{'
+    with pytest.raises(ValueError):
+        CompactCodec(['item01']).decode(data)
+
+    filename = 'sqlite:///{}'.format(tmp_path / 'records.sqlite3')
+    db = recorder.RecordDB(filename)
+    with db.new_session() as sess:
+        db.update_record('alice', 'Case001', b'{"item01": "10"}', 1, False,
+                         True, sess)
+    db = recorder.RecordDB(filename, normalize_values=True, codec=codec)
+    with db.new_session() as sess:
+        db.update_record('bob', 'Case001', db.encode_data({'item02': '20'}), 1,
+                         False, True, sess)
+        assert db.recode_records(sess=sess) == 1
+        records = {r.username: r for r in sess.query(db.Record)}
+        assert records['alice'].data[:1] != b'{'
+        assert records['alice'].to_dict(
+            db.decode_data)['data'] == '{"item01": "10"}'
+        assert db.item_stats(ai=False, sess=sess)['item02']['mean'] == 20
+        assert db.recode_records(recorder.encode_json, sess) == 2
+        assert db.get_record('bob', 'Case001', False,
+                             sess).data == b'{"item02": "20"}'